@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Offline micro-benchmarks of the daemon's hot paths
+
+Mastodon is replaced by an httpx.MockTransport, the database by a temporary
+SQLite file (needs databases[sqlite]). Results are printed as JSON, with
+--baseline the run fails if a benchmark got slower than --threshold.
+
+    python benchmarks/bench.py --output bench_output.txt
+    python benchmarks/bench.py --baseline bench_output.txt --threshold 1.25
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_FILE = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ.setdefault("WEB3CHAN_DATABASE", f"sqlite:///{DB_FILE}")
+os.environ.setdefault("WEB3CHAN_LOGLEVEL", "CRITICAL")
+# measure the outbox write, not the batching window
+os.environ.setdefault("OUTBOX_FLUSH_WINDOW", "0")
+
+import httpx
+import orjson
+
+from web3chan import db
+from web3chan.board import BoardBot
+from web3chan.master import BotMaster
+from web3chan.relationships import RelationshipStore
+from web3chan.timers import TimerWheel
+
+BASE_URL = "https://bench.example"
+ACCOUNT_ID = "1"
+
+
+class FakeMastodon:
+    """Just enough of the Mastodon API for the benchmarks"""
+    def __init__(self, followers=10000, following=10000):
+        self.followers = [str(100000 + i) for i in range(followers)]
+        self.following = [str(100000 + i) for i in range(following)]
+        self.requests = 0
+
+    def account(self):
+        return {"id": ACCOUNT_ID, "acct": "bench", "followers_count": len(self.followers),
+                "following_count": len(self.following)}
+
+    def _page(self, request, ids):
+        # newest first, like Mastodon
+        ids = ids[::-1]
+        limit = int(request.url.params.get("limit", 40))
+        offset = int(request.url.params.get("max_id", 0))
+        page = ids[offset:offset + limit]
+        headers = {}
+        if offset + limit < len(ids):
+            next_url = request.url.copy_merge_params({"max_id": offset + limit})
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return httpx.Response(200, json=[{"id": i, "acct": f"user{i}", "locked": False} for i in page],
+                              headers=headers)
+
+    def handler(self, request):
+        self.requests += 1
+        path = request.url.path
+        if path == "/api/v1/accounts/verify_credentials":
+            return httpx.Response(200, json=self.account())
+        if path == f"/api/v1/accounts/{ACCOUNT_ID}/followers":
+            return self._page(request, self.followers)
+        if path == f"/api/v1/accounts/{ACCOUNT_ID}/following":
+            return self._page(request, self.following)
+        if path.startswith("/api/v1/statuses/") and path.endswith("/reblog"):
+            return httpx.Response(200, json={"id": "1", "reblogged": True})
+        if path.startswith("/api/v1/accounts/") and path.endswith("/follow"):
+            return httpx.Response(200, json={"id": path.split("/")[4], "following": True})
+        if path.startswith("/api/v1/notifications"):
+            return httpx.Response(200, json=[] if request.method == "GET" else {})
+        return httpx.Response(404, json={"error": "not found"})
+
+
+def mention(i, account_id):
+    return {"id": str(i), "type": "mention",
+            "account": {"id": account_id, "acct": f"user{account_id}", "locked": False},
+            "status": {"id": str(500000 + i), "visibility": "public", "in_reply_to_id": None}}
+
+
+def summarize(name, latencies, wall):
+    latencies = sorted(latencies)
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {"name": name, "ops": len(latencies), "throughput": len(latencies) / wall,
+            "mean_us": statistics.fmean(latencies) * 1e6, "p50_us": quantiles[49] * 1e6,
+            "p90_us": quantiles[89] * 1e6, "p99_us": quantiles[98] * 1e6, "max_us": latencies[-1] * 1e6}
+
+
+async def measure(name, n, fn):
+    """Await fn(i) n times, returns a summary dict"""
+    latencies = []
+    started = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        await fn(i)
+        latencies.append(time.perf_counter() - t)
+    return summarize(name, latencies, time.perf_counter() - started)
+
+
+async def make_board(name):
+    instance = await db.Instance.objects.filter(base_url=BASE_URL).first()
+    if instance is None:
+        instance = await db.Instance.objects.create(base_url=BASE_URL, client_id="x", client_secret="x")
+    return await db.Board.objects.create(name=name, instance=instance, access_token="x", enabled=True,
+                                         streaming=False, autofollow=True, replies=True)
+
+
+async def bench_rpc_dispatch(args):
+    master = BotMaster()
+    line = orjson.dumps({"jsonrpc": "2.0", "id": 1, "method": "healthcheck"})
+    batch = orjson.dumps([{"jsonrpc": "2.0", "id": i, "method": "healthcheck"} for i in range(10)])
+    results = [
+        await measure("rpc_dispatch", args.n * 10, lambda i: master._BotMaster__rpc_line(line)),
+        await measure("rpc_dispatch_batch10", args.n, lambda i: master._BotMaster__rpc_line(batch)),
+    ]
+    await master.client.aclose()
+    return results
+
+
+async def bench_stream_decode(args, client):
+    board = await make_board("bench_stream")
+    bot = BoardBot(client, board, TimerWheel())
+    bot.notif_queue.maxsize = args.n * 10 + 1
+    events = [orjson.dumps({"event": "notification", "payload": orjson.dumps(mention(i, "100000")).decode()}).decode()
+              for i in range(args.n * 10)]
+    return [await measure("stream_decode", len(events), lambda i: bot._stream_message(events[i]))]
+
+
+async def bench_notification_handler(args, client, fake):
+    board = await make_board("bench_handler")
+    bot = BoardBot(client, board, TimerWheel())
+    bot.relationships.followers.ids = set(fake.followers)
+    bot.relationships.following.ids = set(fake.following)
+    bot.relationships.synced.set()
+
+    outbox = asyncio.create_task(bot.outbox.run())
+    while not bot.outbox.writing:
+        await asyncio.sleep(0)
+
+    frens = fake.followers
+    results = [await measure(f"notification_handler_mention_{len(frens)}_followers", args.n,
+                             lambda i: bot._handle_notification(mention(i, frens[i % len(frens)])))]
+    results.append(await measure("mentioned_relationship_check", args.n * 100,
+                                 lambda i: _is_fren(bot, frens[i % len(frens)])))
+    outbox.cancel()
+    await asyncio.gather(outbox, return_exceptions=True)
+    return results
+
+
+async def _is_fren(bot, account_id):
+    bot.relationships.is_fren(account_id)
+
+
+async def bench_relationships(args, client, fake):
+    from aroma.api import MastodonAPI
+    api = MastodonAPI(client, BASE_URL, access_token="x")
+    account = fake.account()
+    stores = []
+
+    async def full_sync(i):
+        store = RelationshipStore(api, await make_board(f"bench_rel_{i}"))
+        await store.sync(account)
+        stores.append(store)
+
+    results = [await measure(f"relationships_full_sync_{len(fake.followers)}", max(args.n // 100, 3), full_sync)]
+
+    store = stores[0]
+    requests = fake.requests
+    results.append(await measure("relationships_delta_sync", max(args.n // 10, 10), lambda i: store.sync(account)))
+    results[-1]["requests_per_op"] = (fake.requests - requests) / results[-1]["ops"]
+    return results
+
+
+async def main(args):
+    await db.models.create_all()
+    await db.database.connect()
+
+    fake = FakeMastodon(args.followers, args.followers)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler))
+
+    results = []
+    results += await bench_rpc_dispatch(args)
+    results += await bench_stream_decode(args, client)
+    results += await bench_notification_handler(args, client, fake)
+    results += await bench_relationships(args, client, fake)
+
+    await client.aclose()
+    await db.database.disconnect()
+    return results
+
+
+def compare(results, baseline_file, threshold):
+    with open(baseline_file) as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        old = baseline.get(r["name"])
+        if old and r["p50_us"] > old["p50_us"] * threshold:
+            regressions.append({"name": r["name"], "p50_us": r["p50_us"], "baseline_p50_us": old["p50_us"]})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="web3chan micro-benchmarks")
+    parser.add_argument("-n", type=int, default=1000, help="base number of iterations")
+    parser.add_argument("--followers", type=int, default=10000)
+    parser.add_argument("--output", help="also write results to this file")
+    parser.add_argument("--baseline", help="results file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.25, help="allowed p50 slowdown against baseline")
+    args = parser.parse_args()
+
+    report = {"python": sys.version.split()[0], "results": asyncio.run(main(args))}
+    if args.baseline:
+        report["regressions"] = compare(report["results"], args.baseline, args.threshold)
+
+    output = json.dumps(report, indent=1)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    os.unlink(DB_FILE)
+    sys.exit(1 if report.get("regressions") else 0)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""Local fake Mastodon server for soak tests
+
+Covers what web3chan uses: app creation and login, verify_credentials,
+instance, paged followers/following/notifications, reblog, follow, dismiss
+and a streaming websocket that pushes the generated mentions. Responses can
+be delayed, rate limited, and stream connections dropped at random.
+
+    python benchmarks/fakedon.py --port 18180 --latency 0.05 --mention-rate 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("WEB3CHAN_LOGLEVEL", "WARNING")
+
+from web3chan.metrics import endpoint
+
+FOLLOWER_ID_BASE = 1000000
+STRANGER_ID_BASE = 9000000
+REASONS = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 401: "Unauthorized"}
+
+
+class Account:
+    def __init__(self, account_id, username, followers):
+        self.id = str(account_id)
+        self.username = username
+        self.followers = [str(FOLLOWER_ID_BASE + i) for i in range(followers)]
+        self.following = list(self.followers)
+        # notification id (int) to notification, ascending
+        self.notifications = {}
+        self.streams = set()
+        # ids of reblogged statuses, oldest first
+        self.reblogs = []
+
+    def json(self):
+        return {"id": self.id, "username": self.username, "acct": self.username, "locked": False,
+                "followers_count": len(self.followers), "following_count": len(self.following)}
+
+
+class FakeMastodon:
+    """State and request handlers of the fake instance"""
+    def __init__(self, host="127.0.0.1", port=18180, latency=0.0, rate_limit=0, rate_window=300,
+                 disconnect_interval=0.0, followers=100, fren_ratio=0.9):
+        self.host, self.port = host, port
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.disconnect_interval = disconnect_interval
+        self.followers = followers
+        self.fren_ratio = fren_ratio
+        self.accounts = {}
+        self.tokens = {}
+        # token to (window start, requests in window)
+        self.windows = {}
+        self._ids = itertools.count(100000)
+        self._account_ids = itertools.count(1)
+        self.reset_stats()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def streaming_url(self):
+        return f"ws://{self.host}:{self.port + 1}"
+
+    def reset_stats(self):
+        self.requests = Counter()
+        self.rate_limited = 0
+        self.mentions = 0
+        self.disconnects = 0
+        # status id to (created at, expected to be reblogged)
+        self.pending_reblogs = {}
+        self.reblog_latencies = []
+        self.unexpected_reblogs = 0
+        self.duplicate_reblogs = 0
+
+    def stats(self):
+        latencies = sorted(self.reblog_latencies)
+
+        def percentile(q):
+            return latencies[min(int(q * len(latencies)), len(latencies) - 1)] if latencies else None
+
+        return {
+            "requests": sum(self.requests.values()),
+            "requests_by_endpoint": dict(self.requests.most_common()),
+            "rate_limited": self.rate_limited,
+            "mentions": self.mentions,
+            "reblogs": len(latencies),
+            "missed_reblogs": sum(1 for _, expected in self.pending_reblogs.values() if expected),
+            "unexpected_reblogs": self.unexpected_reblogs,
+            "duplicate_reblogs": self.duplicate_reblogs,
+            "stream_connections": sum(len(a.streams) for a in self.accounts.values()),
+            "stream_disconnects": self.disconnects,
+            "latency": {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99),
+                        "max": latencies[-1] if latencies else None},
+        }
+
+    def account_for(self, username):
+        if username not in self.accounts:
+            self.accounts[username] = Account(next(self._account_ids), username, self.followers)
+        return self.accounts[username]
+
+    # notifications
+
+    def mention(self, account):
+        """Create a mention of account, pushed to its streams"""
+        fren = random.random() < self.fren_ratio
+        if fren and account.followers:
+            author_id = random.choice(account.followers)
+        else:
+            author_id = str(STRANGER_ID_BASE + random.randrange(1000000))
+        status_id = str(next(self._ids))
+        n = {"id": str(next(self._ids)), "type": "mention", "created_at": _now(),
+             "account": {"id": author_id, "acct": f"user{author_id}", "username": f"user{author_id}",
+                         "locked": False},
+             "status": {"id": status_id, "visibility": "public", "in_reply_to_id": None,
+                        "content": "<p>hello</p>"}}
+        account.notifications[int(n["id"])] = n
+        self.pending_reblogs[status_id] = (time.monotonic(), fren)
+        self.mentions += 1
+
+        event = json.dumps({"event": "notification", "payload": json.dumps(n), "stream": ["user:notification"]})
+        for ws in list(account.streams):
+            asyncio.create_task(_send(ws, event))
+
+    async def generate_mentions(self, rate):
+        """Task that mentions random accounts, rate mentions per second in total"""
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            if self.accounts:
+                self.mention(random.choice(list(self.accounts.values())))
+
+    def _notifications_page(self, account, query):
+        limit = min(int(_param(query, "limit", 40)), 80)
+        types = query.get("types[]")
+        notifs = [n for n in account.notifications.values() if not types or n["type"] in types]
+        if "min_id" in query:
+            # the page right after min_id
+            min_id = int(query["min_id"][0])
+            page = [n for n in notifs if int(n["id"]) > min_id][:limit]
+        else:
+            if "max_id" in query:
+                notifs = [n for n in notifs if int(n["id"]) < int(query["max_id"][0])]
+            if "since_id" in query:
+                notifs = [n for n in notifs if int(n["id"]) > int(query["since_id"][0])]
+            page = notifs[-limit:]
+        page = page[::-1]
+
+        links = []
+        if page:
+            links.append(f'<{self.base_url}/api/v1/notifications?limit={limit}&max_id={page[-1]["id"]}>; rel="next"')
+            links.append(f'<{self.base_url}/api/v1/notifications?limit={limit}&min_id={page[0]["id"]}>; rel="prev"')
+        return page, links
+
+    def _accounts_page(self, path, ids, query):
+        # newest first, max_id is an offset into the list
+        limit = min(int(_param(query, "limit", 40)), 80)
+        offset = int(_param(query, "max_id", 0))
+        ids = ids[::-1]
+        page = ids[offset:offset + limit]
+        links = []
+        if offset + limit < len(ids):
+            links.append(f'<{self.base_url}{path}?limit={limit}&max_id={offset + limit}>; rel="next"')
+        return [{"id": i, "acct": f"user{i}", "username": f"user{i}", "locked": False} for i in page], links
+
+    # HTTP
+
+    def _rate_limit_headers(self, token):
+        if not self.rate_limit:
+            return {}, False
+        now = time.time()
+        started, used = self.windows.get(token, (now, 0))
+        if now - started >= self.rate_window:
+            started, used = now, 0
+        limited = used >= self.rate_limit
+        used = min(used + 1, self.rate_limit)
+        self.windows[token] = (started, used)
+        reset = datetime.fromtimestamp(started + self.rate_window, timezone.utc).isoformat()
+        return {"X-RateLimit-Limit": str(self.rate_limit), "X-RateLimit-Remaining": str(self.rate_limit - used),
+                "X-RateLimit-Reset": reset}, limited
+
+    def route(self, method, path, query, form, token):
+        """Returns status, JSON body and Link header values"""
+        account = self.tokens.get(token)
+        parts = path.strip("/").split("/")
+
+        if method == "POST" and path == "/api/v1/apps":
+            return 200, {"id": "1", "name": form.get("client_name", "app"), "client_id": "fakedon_client_id",
+                         "client_secret": "fakedon_client_secret"}, []
+        if method == "POST" and path == "/oauth/token":
+            username = form.get("username", "anonymous")
+            account = self.account_for(username)
+            token = f"tok{account.id}"
+            self.tokens[token] = account
+            return 200, {"access_token": token, "token_type": "Bearer", "scope": form.get("scope", "read"),
+                         "created_at": int(time.time())}, []
+        if method == "GET" and path == "/api/v1/instance":
+            return 200, {"uri": f"{self.host}:{self.port}", "title": "fakedon", "version": "4.0.0",
+                         "urls": {"streaming_api": self.streaming_url}}, []
+
+        if account is None:
+            return 401, {"error": "The access token is invalid"}, []
+
+        if method == "GET" and path == "/api/v1/accounts/verify_credentials":
+            return 200, account.json(), []
+        if method == "GET" and path == "/api/v1/accounts/relationships":
+            ids = query.get("id[]", query.get("id", []))
+            return 200, [{"id": i, "following": i in account.following, "followed_by": i in account.followers}
+                         for i in ids], []
+        if method == "GET" and len(parts) == 5 and parts[4] in ("followers", "following"):
+            ids = account.followers if parts[4] == "followers" else account.following
+            data, links = self._accounts_page(path, ids if parts[3] == account.id else [], query)
+            return 200, data, links
+        if method == "POST" and len(parts) == 5 and parts[2] == "accounts" and parts[4] == "follow":
+            if parts[3] not in account.following:
+                account.following.append(parts[3])
+            return 200, {"id": parts[3], "following": True, "followed_by": parts[3] in account.followers}, []
+        if method == "GET" and len(parts) == 5 and parts[4] == "statuses":
+            limit = min(int(_param(query, "limit", 20)), 40)
+            reblogs = account.reblogs[-limit:][::-1] if parts[3] == account.id else []
+            return 200, [{"id": str(next(self._ids)), "reblog": {"id": i}} for i in reblogs], []
+        if method == "POST" and len(parts) == 5 and parts[2] == "statuses" and parts[4] == "reblog":
+            account.reblogs.append(parts[3])
+            pending = self.pending_reblogs.pop(parts[3], None)
+            if pending is None:
+                self.duplicate_reblogs += 1
+            elif pending[1]:
+                self.reblog_latencies.append(time.monotonic() - pending[0])
+            else:
+                self.unexpected_reblogs += 1
+            return 200, {"id": str(next(self._ids)), "reblogged": True, "reblog": {"id": parts[3]}}, []
+        if method == "GET" and path == "/api/v1/notifications":
+            data, links = self._notifications_page(account, query)
+            return 200, data, links
+        if method == "POST" and path == "/api/v1/notifications/clear":
+            account.notifications.clear()
+            return 200, {}, []
+        if method == "POST" and len(parts) == 5 and parts[2] == "notifications" and parts[4] == "dismiss":
+            account.notifications.pop(int(parts[3]), None)
+            return 200, {}, []
+        if method == "POST" and path == "/api/v1/notifications/dismiss":
+            account.notifications.pop(int(form.get("id", 0)), None)
+            return 200, {}, []
+
+        return 404, {"error": "Record not found"}, []
+
+    async def handle_http(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = line.decode().split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                url = urlsplit(target)
+                query = parse_qs(url.query)
+                form = _parse_form(body, headers.get("content-type", ""))
+                token = headers.get("authorization", "").removeprefix("Bearer ")
+                self.requests[endpoint(method, url.path)] += 1
+
+                if self.latency:
+                    await asyncio.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+
+                extra_headers, limited = self._rate_limit_headers(token)
+                if limited:
+                    self.rate_limited += 1
+                    status, data, links = 429, {"error": "Too many requests"}, []
+                else:
+                    status, data, links = self.route(method, url.path, query, form, token)
+
+                payload = json.dumps(data).encode()
+                response_headers = {"Content-Type": "application/json; charset=utf-8",
+                                    "Content-Length": str(len(payload)), **extra_headers}
+                if links:
+                    response_headers["Link"] = ", ".join(links)
+                head = f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+                head += "".join(f"{k}: {v}\r\n" for k, v in response_headers.items()) + "\r\n"
+                writer.write(head.encode() + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    # streaming
+
+    async def handle_stream(self, ws, path=None):
+        request = getattr(ws, "request", None)
+        path = path or getattr(ws, "path", None) or request.path
+        headers = getattr(ws, "request_headers", None) or request.headers
+        token = _param(parse_qs(urlsplit(path).query), "access_token", "")
+        token = token or headers.get("Authorization", "").removeprefix("Bearer ")
+        account = self.tokens.get(token)
+        if account is None:
+            await ws.close(4001, "invalid access token")
+            return
+
+        account.streams.add(ws)
+        dropper = asyncio.create_task(self._drop_stream(ws)) if self.disconnect_interval else None
+        try:
+            async for _ in ws:
+                # subscribe requests, everything goes to user:notification anyway
+                pass
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            account.streams.discard(ws)
+            if dropper:
+                dropper.cancel()
+
+    async def _drop_stream(self, ws):
+        await asyncio.sleep(random.expovariate(1 / self.disconnect_interval))
+        self.disconnects += 1
+        await ws.close(1001, "going away")
+
+    async def start(self):
+        self.http_server = await asyncio.start_server(self.handle_http, self.host, self.port)
+        self.ws_server = await websockets.serve(self.handle_stream, self.host, self.port + 1)
+
+    async def close(self):
+        self.http_server.close()
+        self.ws_server.close()
+        await self.http_server.wait_closed()
+        await self.ws_server.wait_closed()
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _param(query, key, default=None):
+    values = query.get(key)
+    return values[0] if values else default
+
+
+def _parse_form(body, content_type):
+    if not body:
+        return {}
+    if "json" in content_type:
+        return json.loads(body)
+    return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+
+async def _send(ws, event):
+    try:
+        await ws.send(event)
+    except websockets.ConnectionClosed:
+        pass
+
+
+def add_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18180, help="HTTP port, streaming uses port + 1")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response delay in seconds")
+    parser.add_argument("--rate-limit", type=int, default=300, help="requests per window and token, 0 disables")
+    parser.add_argument("--rate-window", type=int, default=300, help="rate limit window in seconds")
+    parser.add_argument("--disconnect-interval", type=float, default=0.0,
+                        help="mean seconds before a stream connection is dropped, 0 disables")
+    parser.add_argument("--followers", type=int, default=100, help="followers and following per account")
+    parser.add_argument("--fren-ratio", type=float, default=0.9, help="share of mentions from followers")
+    parser.add_argument("--mention-rate", type=float, default=1.0, help="mentions per second, all accounts")
+
+
+def from_args(args):
+    return FakeMastodon(args.host, args.port, args.latency, args.rate_limit, args.rate_window,
+                        args.disconnect_interval, args.followers, args.fren_ratio)
+
+
+async def main(args):
+    fake = from_args(args)
+    await fake.start()
+    print(f"fakedon on {fake.base_url}, streaming on {fake.streaming_url}")
+    generator = asyncio.create_task(fake.generate_mentions(args.mention_rate))
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(json.dumps(fake.stats()))
+    finally:
+        generator.cancel()
+        await fake.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fake Mastodon server for web3chan soak tests")
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""End-to-end soak test of the real daemon against benchmarks/fakedon.py
+
+Starts a fake instance in this process and `python -m web3chan -d` with a
+temporary SQLite database, adds and starts --boards boards, then generates
+mentions for --duration seconds. Reports mention-to-reblog latency, requests
+per notification, and memory and CPU use of the daemon (and its workers) as JSON.
+
+    python benchmarks/soak.py --boards 1000 --duration 3600 --mention-rate 20 --output soak.json
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from web3chan import rpc
+
+import fakedon
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree(pid):
+    """pid and all of its descendants, workers in WEB3CHAN_WORKERS mode"""
+    pids, i = [pid], 0
+    while i < len(pids):
+        try:
+            with open(f"/proc/{pids[i]}/task/{pids[i]}/children") as f:
+                pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            pass
+        i += 1
+    return pids
+
+
+def resource_usage(pid):
+    """RSS in bytes and CPU seconds of a process tree"""
+    rss, cpu = 0, 0.0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/statm") as f:
+                rss += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            continue
+        # utime and stime, fields 14 and 15 of stat
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return rss, cpu
+
+
+async def wait_for_rpc(client, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"daemon exited with code {process.returncode}")
+        try:
+            await client.call("healthcheck")
+            return
+        except OSError:
+            await asyncio.sleep(0.5)
+    raise RuntimeError("daemon RPC didn't come up")
+
+
+async def wait_for_boards(client, count, timeout):
+    """Wait until count boards are running, returns seconds it took"""
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        response = await client.call("list_boards")
+        if sum(1 for b in response.get("result", []) if b[2]) >= count:
+            return time.monotonic() - started
+        await asyncio.sleep(1)
+    raise RuntimeError(f"boards not running after {timeout}s")
+
+
+async def soak(args):
+    tmp = tempfile.mkdtemp()
+    rpc_port = free_port()
+    env = dict(os.environ,
+               WEB3CHAN_DATABASE=f"sqlite:///{os.path.join(tmp, 'soak.db')}",
+               WEB3CHAN_RPC_ADDRESS=f"127.0.0.1:{rpc_port}",
+               WEB3CHAN_RPC_SOCKET="",
+               WEB3CHAN_METRICS_ADDRESS="",
+               WEB3CHAN_STREAMING=str(args.streaming),
+               WEB3CHAN_LOGLEVEL=args.loglevel,
+               WEB3CHAN_WORKERS=str(args.workers))
+    subprocess.run([sys.executable, "-m", "web3chan", "--database", "create"], cwd=ROOT, env=env, check=True)
+
+    fake = fakedon.from_args(args)
+    await fake.start()
+
+    log = open(os.path.join(tmp, "daemon.log"), "w")
+    daemon = subprocess.Popen([sys.executable, "-m", "web3chan", "-d"], cwd=ROOT, env=env,
+                              stdout=log, stderr=subprocess.STDOUT)
+    client = rpc.Client("127.0.0.1", rpc_port)
+    generator = None
+    try:
+        await wait_for_rpc(client, daemon)
+
+        names = [f"soak{i}" for i in range(args.boards)]
+        await asyncio.gather(*[client.call("add_board", name, fake.base_url, f"{name}@fakedon", "password")
+                               for name in names])
+        await asyncio.gather(*[client.call("start_board", name) for name in names])
+        startup_seconds = await wait_for_boards(client, args.boards, args.startup_timeout)
+
+        fake.reset_stats()
+        rss_start, cpu_start = resource_usage(daemon.pid)
+        started = time.monotonic()
+        samples = []
+        generator = asyncio.create_task(fake.generate_mentions(args.mention_rate))
+        while time.monotonic() - started < args.duration:
+            await asyncio.sleep(args.sample_interval)
+            rss, cpu = resource_usage(daemon.pid)
+            samples.append({"t": round(time.monotonic() - started, 1), "rss": rss, "cpu": round(cpu - cpu_start, 2),
+                            "mentions": fake.mentions, "reblogs": len(fake.reblog_latencies)})
+            if args.verbose:
+                print(json.dumps(samples[-1]), file=sys.stderr)
+        generator.cancel()
+
+        # let the daemon catch up before counting missed reblogs
+        await asyncio.sleep(args.drain)
+        elapsed = time.monotonic() - started
+        rss_end, cpu_end = resource_usage(daemon.pid)
+        metrics = (await client.call("metrics")).get("result")
+
+        stats = fake.stats()
+        report = {
+            "boards": args.boards,
+            "duration": round(elapsed, 1),
+            "startup_seconds": round(startup_seconds, 1),
+            "mention_rate": args.mention_rate,
+            "requests_per_notification": stats["requests"] / stats["mentions"] if stats["mentions"] else None,
+            "rss_start": rss_start,
+            "rss_end": rss_end,
+            "rss_growth": rss_end - rss_start,
+            "cpu_seconds": round(cpu_end - cpu_start, 2),
+            "cpu_percent": round(100 * (cpu_end - cpu_start) / elapsed, 1),
+            "fakedon": stats,
+            "samples": samples,
+            "daemon_metrics": metrics,
+        }
+    finally:
+        if generator:
+            generator.cancel()
+        await client.close()
+        # SIGINT is the graceful shutdown that also stops the workers
+        daemon.send_signal(signal.SIGINT)
+        for _ in range(300):
+            if daemon.poll() is not None:
+                break
+            await asyncio.sleep(0.1)
+        else:
+            daemon.kill()
+            daemon.wait()
+        log.close()
+        await fake.close()
+    report["daemon_log"] = log.name
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="web3chan end-to-end soak test")
+    fakedon.add_arguments(parser)
+    parser.add_argument("--boards", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=600, help="seconds of generated load")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for handling after the load")
+    parser.add_argument("--sample-interval", type=float, default=10)
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--workers", type=int, default=0, help="WEB3CHAN_WORKERS of the daemon")
+    parser.add_argument("--no-streaming", dest="streaming", action="store_false")
+    parser.add_argument("--loglevel", default="WARNING", help="WEB3CHAN_LOGLEVEL of the daemon")
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print samples to stderr while running")
+    args = parser.parse_args()
+
+    output = json.dumps(asyncio.run(soak(args)), indent=1)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
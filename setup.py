@@ -20,6 +20,9 @@ setup(
         'websockets',
         'orjson'
     ],
+    extras_require={
+        'http2': ['httpx[http2]']
+    },
     url='https://github.com/web3chan/web3chan',
     author='zhoreeq',
     author_email='zhoreeq@protonmail.com',
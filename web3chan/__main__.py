@@ -3,10 +3,16 @@ import asyncio
 import argparse
 
 from web3chan.master import BotMaster
-from web3chan import db
+from web3chan.sharding import ShardedBotMaster
+from web3chan import config, db
 
 async def daemon(args):
-    web3app = BotMaster()
+    if args.worker is not None:
+        web3app = BotMaster(shard=(args.worker, args.workers))
+    elif config.WORKERS > 0:
+        web3app = ShardedBotMaster(config.WORKERS)
+    else:
+        web3app = BotMaster()
     await web3app.start()
 
 async def database(args):
@@ -21,6 +27,9 @@ def main():
         epilog='BOTTOM TEXT')
     parser.add_argument('-d', '--daemon', action='store_true')
     parser.add_argument('--database', choices=['create', 'drop'])
+    # used internally by WEB3CHAN_WORKERS mode
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, help=argparse.SUPPRESS)
 
     args = parser.parse_args()
 
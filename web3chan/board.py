@@ -1,6 +1,8 @@
 import asyncio
 import orjson
+import random
 import logging
+import time
 
 from contextlib import suppress
 
@@ -8,23 +10,56 @@ import websockets
 
 from aroma.api import MastodonAPI, MastodonError
 
-from web3chan import rpc, config
+from web3chan import rpc, config, scheduler, cache
+from web3chan.cursor import NotificationCursor
+from web3chan.metrics import registry
+from web3chan.dismisser import NotificationDismisser
+from web3chan.outbox import ActionOutbox, REBLOG, FOLLOW
+from web3chan.queues import NotificationQueue
+from web3chan.relationships import RelationshipStore
+from web3chan.utils import SeenCache, id_key
+
+FETCHER_PAGE_LIMIT = 40
+NOTIFICATION_TYPES = ("mention", "status", "reblog", "follow", "follow_request", "favourite", "poll", "update",
+                      "admin.sign_up", "admin.report")
+# per handler worker, keeps notif_queue the place where notifications wait
+WORKER_QUEUE_SIZE = 16
 
 
 class BoardBot:
     """BoardBot worker"""
-    def __init__(self, client, board):
+    def __init__(self, client, board, timers, handler_semaphore=None):
         self.client = client
         self.board = board
+        self.timers = timers
+        # cap on notifications handled at once, BotMaster shares one between all of its boards
+        self.handler_semaphore = handler_semaphore or asyncio.Semaphore(config.HANDLER_GLOBAL_CONCURRENCY)
         self.log = logging.getLogger(str(self))
         self.background_tasks = []
-        self.last_notif_id = None
-        self.notif_queue = asyncio.Queue()
-        self.dismiss_queue = asyncio.Queue()
+        self.board_timers = []
+        self.state = "starting"
+        self.cursor = NotificationCursor(self.board)
+        self.seen_notifs = SeenCache(config.NOTIF_SEEN_CACHE_SIZE)
+        self.notif_queue = NotificationQueue(self.board, config.NOTIF_QUEUE_SIZE, config.NOTIF_OVERFLOW_POLICY,
+                                             on_drop=self._dropped_notification,
+                                             on_drained=self._spill_drained)
+        self.last_fetched_id = None
+        self.fetch_timer = None
+        # notification id to the time it was queued, for handling latency
+        self.received_at = {}
+        self.dismiss_queue = asyncio.Queue(maxsize=config.DISMISS_QUEUE_SIZE)
         self._fetcher_cooldown = config.FETCHER_COOLDOWN
+        self.streaming = False
+        self.stream_task = None
+        # True while the websocket is subscribed to notifications
+        self.stream_connected = False
         self.api = MastodonAPI(self.client, self.board.instance.base_url, access_token=self.board.access_token)
         self.account, self.instance = {}, {}
-        self.following, self.followers = [], []
+        self.relationships = RelationshipStore(self.api, self.board)
+        self.dismisser = NotificationDismisser(self)
+        self.outbox = ActionOutbox(self)
+        # status ids reblogged recently, replies in a thread all point at the same parent
+        self.reblogged = cache.TTLCache(config.REBLOG_CACHE_TTL, config.REBLOG_CACHE_SIZE)
 
         self._notification_handlers = {
             "mention": self._mentioned,
@@ -37,60 +72,133 @@ class BoardBot:
 
     async def start(self):
         try:
-            # TODO: use asyncio.gather lmao
-            self.account = await self.api.account_verify_credentials()
-            self.instance = await self.api.instance()
-            await self._update_relationships()
-        except MastodonError as e:
+            self.account, self.instance, _, _, _, _ = await asyncio.gather(
+                self.api.account_verify_credentials(),
+                cache.instances.fetch(self.board.instance.base_url, self.api.instance),
+                self.cursor.load(), self.relationships.load(), self.notif_queue.clear_spilled(),
+                self.outbox.load()
+            )
+        except Exception as e:
+            # API, network and database errors alike
             self.log.error(f"can't start: {type(e)}: {e}")
             return rpc.INTERNAL_ERROR
 
         self.log.debug(f"instance version: {self.instance['version']}")
+        await self._seed_reblogged()
 
-        tasks = [self._relationships_updater(), self._notification_dismisser(), self._notification_handler(),
-                 self._notification_fetcher()]
+        tasks = [self.dismisser.run(), self.outbox.run(), self._notification_handler()]
 
         if self.board.streaming:
             await self._start_streaming()
 
         for t in tasks:
-            self.background_tasks.append(asyncio.create_task(t))
-
+            self.background_tasks.append(asyncio.create_task(t, name=f"{self.board.name}/{t.__name__}"))
+
+        # periodic jobs run on the shared timer wheel of BotMaster
+        name = self.board.name
+        self.fetch_timer = self.timers.add(name, "fetcher", self._notification_fetcher,
+                                           lambda: self._fetcher_cooldown, delay=0)
+        self.board_timers = [
+            self.fetch_timer,
+            # a cursor flush is one quick write, it doesn't wait behind stuck fetchers
+            self.timers.add(name, "cursor", self._cursor_writer, config.CURSOR_FLUSH_INTERVAL, limited=False)
+        ]
+
+        if config.RELATIONSHIPS_SWEEP:
+            self.board_timers.append(self.timers.add(name, "relationships", self._relationships_updater,
+                                                     config.RELATIONSHIPS_SYNCER_COOLDOWN, delay=0))
+            # relationships are synced in the background, start handling notifications right away
+            self.state = "syncing"
+        else:
+            # frens come from the persisted sets and follow events, or from lazy checks
+            self.relationships.synced.set()
+            self.state = "running"
         self.log.info("started")
         return rpc.OK
 
     async def stop(self):
+        for timer in self.board_timers:
+            await timer.cancel()
+
         for t in self.background_tasks:
             t.cancel()
             with suppress(asyncio.CancelledError):
                 await t
 
+        # actions first, the cursor must not move past notifications whose actions are lost
+        await self.outbox.flush()
+        try:
+            await self.cursor.flush()
+        except Exception as e:
+            self.log.error(f"can't save notification cursor: {type(e)}: {e}")
+
         self.log.info("stopped")
 
+    async def _seed_reblogged(self):
+        """Fill the reblog cache with the board's recent boosts"""
+        if not config.REBLOG_CACHE_SEED:
+            return
+        try:
+            page = await self.api.account_statuses(self.account["id"], params={"limit": config.REBLOG_CACHE_SEED})
+        except Exception as e:
+            self.log.error(f"can't get recent boosts: {type(e)}: {e}")
+            return
+        for status in page.data:
+            if status.get("reblog"):
+                self.reblogged.set(status["reblog"]["id"], True)
+        self.log.debug(f"reblog cache: {len(self.reblogged)} recent boosts")
+
     async def _update_relationships(self):
         self.log.debug("updating relationships")
-        # TODO: use asyncio.gather lmao
-        following = await self.api.get_all(
-            self.api.account_following(self.account["id"], params={"limit": 50})
-        )
-        followers = await self.api.get_all(
-            self.api.account_followers(self.account["id"], params={"limit": 50})
-        )
-        self.following = [a["id"] for a in following]
-        self.followers = [a["id"] for a in followers]
-        self.log.debug(f"{len(self.following)} following")
-        self.log.debug(f"{len(self.followers)} followers")
+        self.account = await self.api.account_verify_credentials()
+        await self.relationships.sync(self.account)
 
     async def _relationships_updater(self):
-        """Task that keeps relationships info up to date"""
-        while True:
-            await asyncio.sleep(config.RELATIONSHIPS_SYNCER_COOLDOWN)
-            try:
-                await self._update_relationships()
-            except MastodonError as e:
-                self.log.error(f"relationships_syncer: {type(e)}: {e}")
+        """Timer job that keeps relationships info up to date"""
+        try:
+            with scheduler.priority(scheduler.BACKGROUND):
+                if self.relationships.synced.is_set():
+                    await self._update_relationships()
+                else:
+                    # initial sync, account info is fresh from start()
+                    await self.relationships.sync(self.account)
+        except Exception as e:
+            self.log.error(f"relationships_syncer: {type(e)}: {e}")
+        finally:
+            # a failed initial sync must not hold notifications back until the next run
+            if not self.relationships.synced.is_set():
+                self.relationships.synced.set()
+                self.state = "running"
+
+    async def _cursor_writer(self):
+        """Timer job that writes the notification cursor back to the database"""
+        try:
+            await self.cursor.flush()
+        except Exception as e:
+            self.log.error(f"cursor_writer: {type(e)}: {e}")
+
+    async def _enqueue_notification(self, n):
+        """Put notification into notif_queue unless it was delivered already"""
+        if self.seen_notifs.add(n["id"]):
+            self.received_at[n["id"]] = time.monotonic()
+            self.cursor.track(n["id"])
+            await self.notif_queue.put(n)
+        else:
+            self.log.debug(f"skipping duplicate notification: {n['id']}")
 
-    async def _start_streaming(self):
+    def _dropped_notification(self, n):
+        """notif_queue overflow callback, the notification won't be handled"""
+        self.received_at.pop(n["id"], None)
+        self.cursor.advance(n["id"])
+        registry.inc("web3chan_notifications_dropped_total", (("board", self.board.name),))
+
+    def _spill_drained(self):
+        """notif_queue read back everything it spilled, fetch what was left on the server meanwhile"""
+        if self.fetch_timer is not None:
+            self.fetch_timer.trigger()
+
+    async def _resolve_streaming_api(self):
+        """Find the streaming endpoint of the instance and check that it accepts connections"""
         streaming_api = None
         if "urls" in self.instance and "streaming_api" in self.instance["urls"]:
             streaming_api = self.instance["urls"]["streaming_api"]
@@ -102,116 +210,281 @@ class BoardBot:
 
         self.log.debug(f"streaming_api = {streaming_api}")
 
+        async with self.api.stream(streaming_api) as ws:
+            await ws.ping()
+        return streaming_api
+
+    async def _start_streaming(self):
         try:
-            async with self.api.stream(streaming_api) as ws:
-                await ws.ping()
-            self.background_tasks.append(asyncio.create_task(self._stream(streaming_api)))
+            # resolved once per instance and shared by all of its boards
+            streaming_api = await cache.streaming_apis.fetch(self.board.instance.base_url,
+                                                             self._resolve_streaming_api)
+            self.stream_task = asyncio.create_task(self._stream(streaming_api), name=f"{self.board.name}/_stream")
+            self.background_tasks.append(self.stream_task)
             self._fetcher_cooldown = config.FETCHER_COOLDOWN_WITH_STREAMING
+            self.streaming = True
         except Exception as e:
             self.log.error(f"streaming: can't start: {type(e)}: {e}")
 
+    async def set_streaming(self, enabled):
+        """Start or stop the stream of a running board, everything else keeps running"""
+        if enabled and not self.streaming:
+            await self._start_streaming()
+        elif not enabled and self.streaming:
+            self.stream_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.stream_task
+            self.background_tasks.remove(self.stream_task)
+            self.stream_task = None
+            self.streaming = False
+            # the fetcher takes over, catch up on what the stream would have delivered
+            self._fetcher_cooldown = config.FETCHER_COOLDOWN
+            self.fetch_timer.trigger()
+            self.log.info("streaming: stopped")
 
     async def _stream(self, streaming_api):
-        """Websocket stream task"""
-        self.log.debug("streaming: starting")
-        async for ws in self.api.stream(streaming_api):
-            self.log.debug("stream: connected")
+        """Websocket stream task
 
+        Reconnects with jittered exponential backoff, a pinger closes connections
+        that stopped answering. Every reconnect triggers a fetch from the cursor
+        to pick up notifications that were sent while disconnected."""
+        self.log.debug("streaming: starting")
+        backoff, connected_before = config.STREAM_BACKOFF_MIN, False
+        while True:
+            connected_at = time.monotonic()
             try:
-                await ws.send(orjson.dumps({"type": "subscribe", "stream": "user:notification"}))
-
-                async for data in ws:
-                    if type(data) != str:
-                        self.log.error(f"stream: received invalid data type: {type(data)}: {data}")
-                        continue
-
+                async with self.api.stream(streaming_api) as ws:
+                    self.log.debug("stream: connected")
+                    if connected_before:
+                        self.fetch_timer.trigger()
+                    connected_before = True
+
+                    await ws.send(orjson.dumps({"type": "subscribe", "stream": "user:notification"}))
+                    pinger = asyncio.create_task(self._stream_pinger(ws), name=f"{self.board.name}/_stream_pinger")
+                    self.stream_connected = True
                     try:
-                        event = orjson.loads(data)
-                    except Exception as e:
-                        self.log.error(f"stream: can't parse event: {type(e): {e}}")
-                        continue
-
-                    if "event" in event and event["event"] == "notification" and "payload" in event:
-                        try:
-                            notification = orjson.loads(event["payload"])
-                        except Exception as e:
-                            self.log.error(f"stream: can't parse payload: {type(e): {e}}")
-                        else:
-                            await self.notif_queue.put(notification)
-                    else:
-                        self.log.error(f"stream: invalid event: {event}")
-
+                        async for data in ws:
+                            await self._stream_message(data)
+                    finally:
+                        self.stream_connected = False
+                        pinger.cancel()
+                self.log.debug("stream: connection closed")
             except websockets.ConnectionClosed:
                 self.log.debug("stream: connection closed")
-                continue
-
-    async def _notification_dismisser(self):
-        """Dismiss notifications"""
+            except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake) as e:
+                self.log.error(f"stream: can't connect: {type(e)}: {e}")
+            except Exception as e:
+                # e.g. a malformed payload or a spill queue error, reconnect anyway
+                self.log.error(f"stream: error: {type(e)}: {e}")
+
+            registry.inc("web3chan_stream_reconnects_total", (("board", self.board.name),))
+            if time.monotonic() - connected_at > config.STREAM_BACKOFF_MAX:
+                # the connection was healthy for a while, start over
+                backoff = config.STREAM_BACKOFF_MIN
+            delay = random.uniform(0, backoff)
+            backoff = min(backoff * 2, config.STREAM_BACKOFF_MAX)
+            self.log.debug(f"stream: reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _stream_pinger(self, ws):
+        """Close the websocket if it doesn't answer pings"""
         while True:
-            n = await self.dismiss_queue.get()
-            self.log.debug(f"dismissing notification: {n['id']}")
+            await asyncio.sleep(config.STREAM_PING_INTERVAL)
             try:
-                await self.api.notification_dismiss(n["id"])
-            except MastodonError as e:
-                self.log.error(f"notification_dismisser: {type(e)}: {e}")
+                pong = await ws.ping()
+                await asyncio.wait_for(pong, config.STREAM_PING_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.log.warning("stream: ping timeout")
+                await ws.close()
+                return
+            except websockets.ConnectionClosed:
+                return
 
-    async def _notification_fetcher(self):
-        """Fetch notifications periodically so we don't miss anything"""
-        while True:
-            self.log.debug("fetching notifications")
+    async def _stream_message(self, data):
+        if type(data) != str:
+            self.log.error(f"stream: received invalid data type: {type(data)}: {data}")
+            return
+
+        try:
+            event = orjson.loads(data)
+        except Exception as e:
+            self.log.error(f"stream: can't parse event: {type(e)}: {e}")
+            return
+
+        if "event" in event and event["event"] == "notification" and "payload" in event:
             try:
-                notifs = await self.api.get_all(self.api.notifications(params={
-                    "limit": 50, "since_id": self.last_notif_id
-                }))
-            except MastodonError as e:
-                self.log.error(f"can't fetch notifications: {type(e)}: {e}")
+                notification = orjson.loads(event["payload"])
+            except Exception as e:
+                self.log.error(f"stream: can't parse payload: {type(e)}: {e}")
             else:
-                self.log.debug(f"fetched {len(notifs)} notifications")
-                if notifs:
-                    self.last_notif_id = notifs[-1]["id"]
-                    for n in notifs:
-                        await self.notif_queue.put(n)
+                if self.notif_queue.spilled:
+                    # backed up, the fetcher picks it up from the cursor once the spill is read back
+                    return
+                await self._enqueue_notification(notification)
+        else:
+            self.log.error(f"stream: invalid event: {event}")
 
-            await asyncio.sleep(self._fetcher_cooldown)
+    async def _fetch_notifications(self):
+        """Fetch new notifications oldest first, page by page
+
+        Every page is queued before the next one is requested, so a huge backlog
+        never sits in memory and fetching pauses while notif_queue is full. With the
+        spill policy fetching stops once notifications are spilled, queued ones are
+        tracked in memory and the rest is cheap to fetch again from the cursor."""
+        min_id = self.last_fetched_id or self.cursor.last_id
+        fetched = 0
+        while True:
+            params = {"limit": FETCHER_PAGE_LIMIT, **self.notification_filter()}
+            if min_id:
+                params["min_id"] = min_id
+            with scheduler.priority(scheduler.BACKGROUND):
+                page = await self.api.notifications(params=params)
+            notifs = sorted(page.data, key=lambda n: id_key(n["id"]))
+            for n in notifs:
+                await self._enqueue_notification(n)
+            fetched += len(notifs)
+            if notifs:
+                min_id = self.last_fetched_id = notifs[-1]["id"]
+            if len(notifs) < FETCHER_PAGE_LIMIT or self.notif_queue.spilled:
+                return fetched
+
+    def notification_filter(self):
+        """Query params that make the server only return notification types we handle
+
+        types[] is Mastodon 3.5+, exclude_types[] covers older versions, include_types[] is Pleroma"""
+        types = list(self._notification_handlers)
+        return {"types[]": types, "include_types[]": types,
+                "exclude_types[]": [t for t in NOTIFICATION_TYPES if t not in types]}
+
+    def _adapt_fetcher_cooldown(self, fetched):
+        """Poll more often while the board is busy and back off while it's idle"""
+        if self.streaming or not config.FETCHER_ADAPTIVE:
+            return
+        if fetched:
+            self._fetcher_cooldown = max(config.FETCHER_COOLDOWN_MIN, self._fetcher_cooldown / 2)
+        else:
+            self._fetcher_cooldown = min(config.FETCHER_COOLDOWN_MAX, self._fetcher_cooldown * 1.5)
+        self.log.debug(f"fetcher cooldown: {self._fetcher_cooldown:.0f}s")
+
+    async def _notification_fetcher(self):
+        """Timer job that fetches notifications so we don't miss anything"""
+        if self.notif_queue.spilled:
+            self.log.debug(f"notif_queue has {self.notif_queue.spilled} spilled notifications, not fetching")
+            return
+        self.log.debug("fetching notifications")
+        try:
+            fetched = await self._fetch_notifications()
+        except MastodonError as e:
+            self.log.error(f"can't fetch notifications: {type(e)}: {e}")
+        else:
+            self.log.debug(f"fetched {fetched} notifications")
+            self._adapt_fetcher_cooldown(fetched)
 
     async def _notification_handler(self):
-        """Main board logic"""
+        """Main board logic
+
+        Notifications are sharded by account over HANDLER_WORKERS workers, so events
+        of one account are handled in order while different accounts don't wait
+        for each other."""
+        queues = [asyncio.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(config.HANDLER_WORKERS)]
+        workers = [asyncio.create_task(self._notification_worker(q), name=f"{self.board.name}/_notification_worker{i}")
+                   for i, q in enumerate(queues)]
+        try:
+            while True:
+                n = await self.notif_queue.get()
+                account_id = n["account"]["id"] if "account" in n else ""
+                await queues[hash(account_id) % len(queues)].put(n)
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _notification_worker(self, queue):
         while True:
-            n = await self.notif_queue.get()
+            n = await queue.get()
+            if n.get("type") == "mention" and self.relationships.checker is None \
+                    and not self.relationships.synced.is_set() \
+                    and not self.relationships.is_fren(n["account"]["id"]):
+                # the author may be missing from the persisted relationships, wait for the initial sync
+                await self.relationships.synced.wait()
+
+            attempt = 1
+            while True:
+                # global cap on notifications handled at once by all boards of this process
+                async with self.handler_semaphore:
+                    handled = await self._handle_notification(n, attempt)
+                if handled:
+                    break
+                # retried in order, later notifications of the same accounts wait
+                delay = config.HANDLER_RETRY_DELAY * 2 ** (attempt - 1)
+                self.log.warning(f"retrying notification {n['id']} in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+            # the dismiss queue may be full, don't hold a global permit while waiting for it
+            await self.dismiss_queue.put(n)
 
-            self.log.debug(f"handling notification: {n['id']}")
+    async def _handle_notification(self, n, attempt=1):
+        """Handle a notification, returns False if it failed and should be retried
+
+        Errors are temporary (API, network, database, outbox) unless the notification
+        is malformed, the cursor only moves past a notification that was handled,
+        is malformed or failed HANDLER_MAX_ATTEMPTS times."""
+        self.log.debug(f"handling notification: {n['id']}")
+        try:
             if "type" in n and n["type"] in self._notification_handlers:
-                await self._notification_handlers[n["type"]](n)
+                with scheduler.priority(scheduler.HIGH):
+                    await self._notification_handlers[n["type"]](n)
             else:
                 self.log.warning(f"unhandled notification: {n}")
-
-            await self.dismiss_queue.put(n)
+        except (KeyError, TypeError, AttributeError) as e:
+            self.log.error(f"malformed notification {n.get('id')}: {type(e)}: {e}")
+            registry.inc("web3chan_notifications_failed_total", (("board", self.board.name),))
+        except Exception as e:
+            if attempt < config.HANDLER_MAX_ATTEMPTS:
+                self.log.error(f"can't handle notification {n['id']}, attempt {attempt}: {type(e)}: {e}")
+                return False
+            self.log.error(f"can't handle notification {n['id']}, giving up: {type(e)}: {e}")
+            registry.inc("web3chan_notifications_failed_total", (("board", self.board.name),))
+
+        # notifications that planned an action are timed by the outbox, until the action is done
+        received_at = self.received_at.pop(n["id"], None)
+        if received_at is not None:
+            registry.observe("web3chan_notification_latency_seconds", time.monotonic() - received_at,
+                             (("type", n.get("type")),))
+        self.cursor.advance(n["id"])
+        return True
 
     async def _followed(self, n):
         self.log.debug(f"followed by {n['account']['acct']}")
-        self.followers.append(n['account']['id'])
+        await self.relationships.add_follower(n['account']['id'])
 
         if self.board.autofollow and not n['account']['locked']:
-            try:
-                relationship = await self.api.account_follow(n['account']['id'])
-                if relationship["following"]:
-                    self.following.append(n['account']['id'])
-                    self.log.info(f"followed {n['account']['acct']}")
-            except MastodonError as e:
-                self.log.error(f"can't follow {n['account']['acct']}: {type(e)}: {e}")
+            # followed by the outbox executors
+            await self.outbox.plan(FOLLOW, n['account']['id'], n['account']['acct'],
+                                   self.received_at.pop(n["id"], None))
 
     async def _mentioned(self, n):
         self.log.debug(f"mentioned by {n['account']['acct']}")
 
-        is_fren = n["account"]["id"] in self.followers and n["account"]["id"] in self.following
+        is_fren = await self.relationships.check_fren(n["account"]["id"])
 
         if is_fren and n["status"]["visibility"] == "public":
             status_id = n["status"]["id"]
             if self.board.replies and "in_reply_to_id" in n["status"] and n["status"]["in_reply_to_id"]:
                 status_id = n["status"]["in_reply_to_id"]
 
+            labels = (("board", self.board.name),)
+            if self.reblogged.get(status_id):
+                registry.inc("web3chan_reblog_cache_hits_total", labels)
+                self.log.debug(f"already reblogged: {status_id}")
+                return
+            registry.inc("web3chan_reblog_cache_misses_total", labels)
+
+            # reblogged by the outbox executors, a status only once
+            self.reblogged.set(status_id, True)
             try:
-                await self.api.status_reblog(status_id)
-                self.log.info(f"reblogged {n['account']['acct']}/{status_id}")
-            except MastodonError as e:
-                self.log.error(f"can't reblog {n['account']['acct']}/{status_id}: {type(e)}: {e}")
+                await self.outbox.plan(REBLOG, status_id, f"{n['account']['acct']}/{status_id}",
+                                       self.received_at.pop(n["id"], None))
+            except Exception:
+                self.reblogged.discard(status_id)
+                raise
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from collections import OrderedDict
+
+from web3chan import config
+
+
+class TTLCache:
+    """Key-value cache with per-entry expiration and an optional size limit
+
+    fetch() merges concurrent lookups of the same missing key into one call."""
+    def __init__(self, ttl, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        if self.maxsize is not None and len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    async def fetch(self, key, fetcher):
+        """Return cached value or await fetcher() and cache its result"""
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+        if key not in self._pending:
+            task = asyncio.ensure_future(fetcher())
+            self._pending[key] = task
+            task.add_done_callback(lambda t: self._fetched(key, t))
+        # shield so that a cancelled caller doesn't cancel the lookup for everybody else
+        return await asyncio.shield(self._pending[key])
+
+    def _fetched(self, key, task):
+        del self._pending[key]
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result())
+
+
+# instance metadata shared by all boards, keyed by Instance.base_url
+instances = TTLCache(config.INSTANCE_INFO_TTL)
+# checked streaming endpoints, keyed by Instance.base_url
+streaming_apis = TTLCache(config.INSTANCE_INFO_TTL)
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+
+from web3chan import config, db
+from web3chan.registry import board_state
+from web3chan.utils import HashRing
+
+
+class LeaseManager:
+    """Spreads boards across daemons sharing one database
+
+    Every node heartbeats into the nodes table. Enabled boards are mapped to live
+    nodes by consistent hashing, a node runs a board only while it holds the
+    board's lease. Leases are claimed and renewed with conditional UPDATEs, so
+    a lease of a dead node can be taken over as soon as it expires and no extra
+    coordination service is needed."""
+    def __init__(self, master):
+        self.master = master
+        self.node_id = config.NODE_ID
+        self.log = logging.getLogger(f"LeaseManager:{self.node_id}")
+        # boards stopped with the stop_board RPC, not started again until start_board
+        self.paused = set()
+        self.tasks = set()
+
+    async def run(self):
+        while True:
+            try:
+                await self.rebalance()
+            except Exception as e:
+                self.log.error(f"can't rebalance: {type(e)}: {e}")
+            await asyncio.sleep(config.LEASE_RENEW_INTERVAL)
+
+    async def stop(self):
+        """Give up all leases so other nodes can take over right away"""
+        await db.BoardLease.objects.filter(owner=self.node_id).update(expires_at=0.0)
+        await db.Node.objects.filter(node_id=self.node_id).delete()
+
+    async def holds(self, name):
+        lease = await db.BoardLease.objects.filter(board_name=name).first()
+        return lease is not None and lease.owner == self.node_id and lease.expires_at > time.time()
+
+    async def _heartbeat(self, expires_at):
+        node = await db.Node.objects.filter(node_id=self.node_id).first()
+        if node:
+            await node.update(expires_at=expires_at)
+        else:
+            await db.Node.objects.create(node_id=self.node_id, expires_at=expires_at)
+
+    async def _create_leases(self, names):
+        for name in names:
+            try:
+                await db.BoardLease.objects.create(board_name=name, owner="", expires_at=0.0)
+            except Exception as e:
+                # another node created it first
+                self.log.debug(f"can't create lease for {name}: {type(e)}: {e}")
+
+    async def rebalance(self):
+        now = time.time()
+        expires_at = now + config.LEASE_TTL
+        await self._heartbeat(expires_at)
+
+        nodes = [n.node_id for n in await db.Node.objects.filter(expires_at__gt=now).all()]
+        ring = HashRing(nodes or [self.node_id])
+        # also picks up boards added or changed through other nodes
+        old = {name: board_state(b) for name, b in self.master.boards.boards.items()}
+        boards = [b for b in await self.master.boards.load() if b.enabled]
+        # option changes made through other nodes are applied to running boards in place
+        await asyncio.gather(*[self.master.apply_changes(name, old.get(name)) for name in list(self.master.slaves)])
+        wanted = {b.name for b in boards if ring.node_for(b.name) == self.node_id} - self.paused
+
+        leases = {l.board_name: l for l in await db.BoardLease.objects.all()}
+        await self._create_leases(wanted - leases.keys())
+
+        running = set(self.master.slaves) | self.master.starting
+        moved = running - wanted
+        if moved:
+            # boards that moved to another node or got disabled, stop them before giving up the lease
+            for name in moved:
+                await self.master.stop_slave(name)
+            await db.BoardLease.objects.filter(owner=self.node_id, board_name__in=list(moved)).update(
+                expires_at=0.0)
+
+        if wanted:
+            # renew our leases, then take over free and expired ones
+            await db.BoardLease.objects.filter(owner=self.node_id, board_name__in=list(wanted)).update(
+                expires_at=expires_at)
+            await db.BoardLease.objects.filter(expires_at__lt=now, board_name__in=list(wanted)).update(
+                owner=self.node_id, expires_at=expires_at)
+
+        held = {l.board_name for l in await db.BoardLease.objects.filter(owner=self.node_id,
+                                                                         expires_at__gt=now).all()}
+
+        # lost a lease, i.e. after a long pause another node took over
+        for name in set(self.master.slaves) - held:
+            self.log.warning(f"lost lease for {name}")
+            await self.master.stop_slave(name)
+
+        for name in (held & wanted) - running:
+            task = asyncio.create_task(self.master.start_board(name))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+
+async def wait_released(name, node_id, timeout):
+    """Wait until no other node than node_id (or its workers) holds the lease of a board, at most timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        owner = (await lease_owners()).get(name)
+        if owner is None or owner == node_id or owner.startswith(f"{node_id}/"):
+            return
+        await asyncio.sleep(1)
+
+
+async def lease_owners():
+    """Board name to node id of all unexpired leases"""
+    leases = await db.BoardLease.objects.filter(expires_at__gt=time.time()).all()
+    return {l.board_name: l.owner for l in leases}
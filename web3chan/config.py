@@ -1,4 +1,5 @@
 import os
+import socket
 import logging
 
 
@@ -15,12 +16,83 @@ def env_var(key, default=None):
 APP_NAME = env_var("WEB3CHAN_APP_NAME", "web3chan")
 DATABASE = env_var("WEB3CHAN_DATABASE", "")
 RPC_ADDRESS = env_var("WEB3CHAN_RPC_ADDRESS", "127.0.0.1:18166")
+RPC_SOCKET = env_var("WEB3CHAN_RPC_SOCKET", "")
+RPC_PIPELINE_CONCURRENCY = int(env_var("RPC_PIPELINE_CONCURRENCY", "16"))
+RPC_MAX_LINE = int(env_var("RPC_MAX_LINE", str(16 * 1024 * 1024)))
+# timeout of calls from the sharded master to its workers
+RPC_CALL_TIMEOUT = float(env_var("RPC_CALL_TIMEOUT", "60"))
+WORKERS = int(env_var("WEB3CHAN_WORKERS", "0"))
+WORKER_RESTART_DELAY = int(env_var("WORKER_RESTART_DELAY", "5"))
+# how often workers check that the master process is still alive
+WORKER_PARENT_CHECK_INTERVAL = float(env_var("WORKER_PARENT_CHECK_INTERVAL", "1"))
+CLUSTER = env_var("WEB3CHAN_CLUSTER", "False")
+NODE_ID = env_var("WEB3CHAN_NODE_ID", f"{socket.gethostname()}:{RPC_ADDRESS.split(':')[-1]}")
+LEASE_TTL = int(env_var("LEASE_TTL", "30"))
+LEASE_RENEW_INTERVAL = int(env_var("LEASE_RENEW_INTERVAL", "10"))
 AUTOFOLLOW = env_var("WEB3CHAN_AUTOFOLLOW", "True")
 REPLIES = env_var("WEB3CHAN_REPLIES", "True")
 STREAMING = env_var("WEB3CHAN_STREAMING", "False")
 FETCHER_COOLDOWN = int(env_var("FETCHER_COOLDOWN", "120"))
+FETCHER_COOLDOWN_MIN = int(env_var("FETCHER_COOLDOWN_MIN", "15"))
+FETCHER_COOLDOWN_MAX = int(env_var("FETCHER_COOLDOWN_MAX", "600"))
+FETCHER_ADAPTIVE = env_var("FETCHER_ADAPTIVE", "True")
 FETCHER_COOLDOWN_WITH_STREAMING = int(env_var("FETCHER_COOLDOWN_WITH_STREAMING", "300"))
+TIMER_RESOLUTION = float(env_var("TIMER_RESOLUTION", "1"))
+TIMER_JITTER = float(env_var("TIMER_JITTER", "0.1"))
+TIMER_CONCURRENCY = int(env_var("TIMER_CONCURRENCY", "64"))
+STREAM_BACKOFF_MIN = float(env_var("STREAM_BACKOFF_MIN", "1"))
+STREAM_BACKOFF_MAX = float(env_var("STREAM_BACKOFF_MAX", "60"))
+STREAM_PING_INTERVAL = float(env_var("STREAM_PING_INTERVAL", "30"))
+STREAM_PING_TIMEOUT = float(env_var("STREAM_PING_TIMEOUT", "10"))
 RELATIONSHIPS_SYNCER_COOLDOWN = int(env_var("RELATIONSHIPS_SYNCER_COOLDOWN", "1800"))
+RELATIONSHIPS_SWEEP = env_var("RELATIONSHIPS_SWEEP", "True")
+RELATIONSHIPS_LAZY = env_var("RELATIONSHIPS_LAZY", "False")
+RELATIONSHIPS_CACHE_TTL = int(env_var("RELATIONSHIPS_CACHE_TTL", "3600"))
+RELATIONSHIPS_CACHE_SIZE = int(env_var("RELATIONSHIPS_CACHE_SIZE", "10000"))
+RELATIONSHIPS_BATCH_WINDOW = float(env_var("RELATIONSHIPS_BATCH_WINDOW", "0.05"))
+RELATIONSHIPS_BATCH_SIZE = int(env_var("RELATIONSHIPS_BATCH_SIZE", "40"))
+CURSOR_FLUSH_INTERVAL = int(env_var("CURSOR_FLUSH_INTERVAL", "10"))
+NOTIF_QUEUE_SIZE = int(env_var("NOTIF_QUEUE_SIZE", "1000"))
+NOTIF_OVERFLOW_POLICY = env_var("NOTIF_OVERFLOW_POLICY", "block")
+DISMISS_QUEUE_SIZE = int(env_var("DISMISS_QUEUE_SIZE", "1000"))
+HANDLER_WORKERS = int(env_var("HANDLER_WORKERS", "4"))
+HANDLER_GLOBAL_CONCURRENCY = int(env_var("HANDLER_GLOBAL_CONCURRENCY", "64"))
+HANDLER_MAX_ATTEMPTS = int(env_var("HANDLER_MAX_ATTEMPTS", "5"))
+HANDLER_RETRY_DELAY = float(env_var("HANDLER_RETRY_DELAY", "5"))
+DISMISS_BATCH_SIZE = int(env_var("DISMISS_BATCH_SIZE", "20"))
+DISMISS_BATCH_WINDOW = float(env_var("DISMISS_BATCH_WINDOW", "1"))
+DISMISS_CONCURRENCY = int(env_var("DISMISS_CONCURRENCY", "4"))
+DISMISS_CLEAR_THRESHOLD = int(env_var("DISMISS_CLEAR_THRESHOLD", "100"))
+NOTIF_SEEN_CACHE_SIZE = int(env_var("NOTIF_SEEN_CACHE_SIZE", "1024"))
+REBLOG_CACHE_TTL = int(env_var("REBLOG_CACHE_TTL", str(6 * 3600)))
+REBLOG_CACHE_SIZE = int(env_var("REBLOG_CACHE_SIZE", "2048"))
+REBLOG_CACHE_SEED = int(env_var("REBLOG_CACHE_SEED", "40"))
+OUTBOX_FLUSH_WINDOW = float(env_var("OUTBOX_FLUSH_WINDOW", "0.05"))
+OUTBOX_CONCURRENCY = int(env_var("OUTBOX_CONCURRENCY", "2"))
+OUTBOX_MAX_ATTEMPTS = int(env_var("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_DELAY = float(env_var("OUTBOX_RETRY_DELAY", "30"))
+OUTBOX_RETENTION = int(env_var("OUTBOX_RETENTION", str(7 * 24 * 3600)))
+OUTBOX_KEYS_CACHE_SIZE = int(env_var("OUTBOX_KEYS_CACHE_SIZE", "10000"))
+OUTBOX_PRUNE_INTERVAL = int(env_var("OUTBOX_PRUNE_INTERVAL", "3600"))
+INSTANCE_INFO_TTL = int(env_var("INSTANCE_INFO_TTL", "3600"))
+STARTUP_CONCURRENCY = int(env_var("STARTUP_CONCURRENCY", "32"))
+STARTUP_CONCURRENCY_PER_INSTANCE = int(env_var("STARTUP_CONCURRENCY_PER_INSTANCE", "4"))
+PROVISION_CONCURRENCY = int(env_var("PROVISION_CONCURRENCY", "32"))
+PROVISION_CONCURRENCY_PER_INSTANCE = int(env_var("PROVISION_CONCURRENCY_PER_INSTANCE", "4"))
+HTTP2 = env_var("WEB3CHAN_HTTP2", "False")
+HTTP_MAX_CONNECTIONS = int(env_var("HTTP_MAX_CONNECTIONS", "10"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(env_var("HTTP_MAX_KEEPALIVE_CONNECTIONS", "5"))
+HTTP_KEEPALIVE_EXPIRY = float(env_var("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_TIMEOUT = float(env_var("HTTP_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(env_var("HTTP_POOL_TIMEOUT", "30"))
+RATELIMIT_CONCURRENCY = int(env_var("RATELIMIT_CONCURRENCY", "8"))
+RATELIMIT_MAX_RETRIES = int(env_var("RATELIMIT_MAX_RETRIES", "2"))
+RATELIMIT_DEFAULT_WAIT = int(env_var("RATELIMIT_DEFAULT_WAIT", "60"))
+
+METRICS_ADDRESS = env_var("WEB3CHAN_METRICS_ADDRESS", "")
+METRICS_LOOP_LAG_INTERVAL = float(env_var("METRICS_LOOP_LAG_INTERVAL", "1"))
+PROFILE_MAX_DURATION = float(env_var("PROFILE_MAX_DURATION", "300"))
+PROFILE_SAMPLE_INTERVAL = float(env_var("PROFILE_SAMPLE_INTERVAL", "0.01"))
 
 LOGLEVEL = env_var("WEB3CHAN_LOGLEVEL", "DEBUG")
 if LOGLEVEL in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
@@ -0,0 +1,57 @@
+import heapq
+
+from web3chan import db
+from web3chan.utils import id_key
+
+
+class NotificationCursor:
+    """Id of the last handled notification
+
+    Notifications are handled concurrently, so the cursor only moves past an id
+    once every older queued notification is handled too. Advancing the cursor
+    only happens in memory, flush() writes it back to the database."""
+    def __init__(self, board):
+        self.board = board
+        self.last_id = None
+        # queued and not yet handled notification ids, the heap has stale entries of handled ids
+        self.pending = set()
+        self._pending_heap = []
+        self._handled = []
+        self._row = None
+        self._dirty = False
+
+    async def load(self):
+        self._row = await db.NotificationCursor.objects.filter(board=self.board).first()
+        if self._row:
+            self.last_id = self._row.last_notif_id
+
+    def track(self, notif_id):
+        """Called when a notification is queued"""
+        self.pending.add(notif_id)
+        heapq.heappush(self._pending_heap, (id_key(notif_id), notif_id))
+
+    def advance(self, notif_id):
+        """Called when a notification is handled"""
+        self.pending.discard(notif_id)
+        heapq.heappush(self._handled, (id_key(notif_id), notif_id))
+        while self._pending_heap and self._pending_heap[0][1] not in self.pending:
+            heapq.heappop(self._pending_heap)
+        oldest_pending = self._pending_heap[0][0] if self._pending_heap else None
+        while self._handled and (oldest_pending is None or self._handled[0][0] < oldest_pending):
+            key, handled_id = heapq.heappop(self._handled)
+            if self.last_id is None or key > id_key(self.last_id):
+                self.last_id = handled_id
+                self._dirty = True
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            if self._row is None:
+                self._row = await db.NotificationCursor.objects.create(board=self.board, last_notif_id=self.last_id)
+            else:
+                await self._row.update(last_notif_id=self.last_id)
+        except Exception:
+            self._dirty = True
+            raise
@@ -9,6 +9,21 @@ from web3chan import config
 database = databases.Database(config.DATABASE)
 models = orm.ModelRegistry(database=database)
 
+# rows or ids per statement, stays under the bind parameter limits of SQLite and PostgreSQL
+CHUNK_SIZE = 500
+
+
+def chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def insert_many(model, rows):
+    """Insert many rows in chunks, foreign keys are given as ids"""
+    for chunk in chunks(rows):
+        await database.execute_many(model.objects.table.insert(), chunk)
+
 
 class Instance(orm.Model):
     tablename = "instances"
@@ -34,3 +49,82 @@ class Board(orm.Model):
         "autofollow": orm.Boolean(),
         "replies": orm.Boolean()
     }
+
+
+class Follower(orm.Model):
+    tablename = "followers"
+    registry = models
+    fields = {
+        "id": orm.Integer(primary_key=True),
+        "board": orm.ForeignKey(Board, on_delete=orm.CASCADE),
+        "account_id": orm.String(max_length=64, index=True),
+    }
+
+
+class Following(orm.Model):
+    tablename = "following"
+    registry = models
+    fields = {
+        "id": orm.Integer(primary_key=True),
+        "board": orm.ForeignKey(Board, on_delete=orm.CASCADE),
+        "account_id": orm.String(max_length=64, index=True),
+    }
+
+
+class NotificationCursor(orm.Model):
+    tablename = "notification_cursors"
+    registry = models
+    fields = {
+        "id": orm.Integer(primary_key=True),
+        "board": orm.ForeignKey(Board, on_delete=orm.CASCADE),
+        "last_notif_id": orm.String(max_length=64),
+    }
+
+
+class Node(orm.Model):
+    tablename = "nodes"
+    registry = models
+    fields = {
+        "id": orm.Integer(primary_key=True),
+        "node_id": orm.String(max_length=200, unique=True),
+        "expires_at": orm.Float(),
+    }
+
+
+class BoardLease(orm.Model):
+    tablename = "board_leases"
+    registry = models
+    fields = {
+        "id": orm.Integer(primary_key=True),
+        "board_name": orm.String(max_length=200, unique=True),
+        "owner": orm.String(max_length=200),
+        "expires_at": orm.Float(),
+    }
+
+
+class SpilledNotification(orm.Model):
+    tablename = "spilled_notifications"
+    registry = models
+    fields = {
+        "id": orm.Integer(primary_key=True),
+        "board": orm.ForeignKey(Board, on_delete=orm.CASCADE),
+        "notif_id": orm.String(max_length=64),
+        "payload": orm.Text(),
+    }
+
+
+class Action(orm.Model):
+    tablename = "actions"
+    registry = models
+    fields = {
+        "id": orm.Integer(primary_key=True),
+        "board": orm.ForeignKey(Board, on_delete=orm.CASCADE),
+        # board id, kind and target id, one action per status or account
+        "key": orm.String(max_length=200, unique=True),
+        "kind": orm.String(max_length=16),
+        "target_id": orm.String(max_length=64),
+        "label": orm.String(max_length=200),
+        "state": orm.String(max_length=16, index=True),
+        "attempts": orm.Integer(),
+        "updated_at": orm.Float(),
+    }
@@ -0,0 +1,164 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import time
+
+from collections import Counter, deque
+
+from web3chan import config
+from web3chan.metrics import registry
+
+CPROFILE, SAMPLING = "cprofile", "sampling"
+
+
+def _frame_label(frame, lineno=True):
+    code = frame.f_code
+    location = f"{os.path.basename(code.co_filename)}:{frame.f_lineno}" if lineno else os.path.basename(code.co_filename)
+    return f"{code.co_name} ({location})"
+
+
+class Profiler:
+    """Profiles the event loop thread, one session at a time
+
+    cprofile - deterministic, traces every call and slows the daemon down
+    sampling - a SIGPROF timer records the stack every PROFILE_SAMPLE_INTERVAL of CPU
+               time, cheap enough to run on a busy node. Idle time isn't sampled.
+
+    Sessions stop by themselves after at most PROFILE_MAX_DURATION seconds."""
+    def __init__(self):
+        self.log = logging.getLogger("Profiler")
+        self.mode = None
+        self.started_at = None
+        self.duration = None
+        self._profile = None
+        self._stats = None
+        self._samples = Counter()
+        self._sampling = False
+        self._timeout = None
+
+    @property
+    def running(self):
+        return self._profile is not None or self._sampling
+
+    def start(self, mode=SAMPLING, duration=None):
+        if self.running:
+            raise RuntimeError("profiler is already running")
+        if mode not in (CPROFILE, SAMPLING):
+            raise ValueError(f"invalid profiler mode: {mode}")
+
+        self.mode, self.started_at = mode, time.time()
+        self.duration = min(duration or config.PROFILE_MAX_DURATION, config.PROFILE_MAX_DURATION)
+        self._stats, self._samples = None, Counter()
+        if mode == CPROFILE:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            # the handler runs in the main thread, which is the loop thread
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, config.PROFILE_SAMPLE_INTERVAL, config.PROFILE_SAMPLE_INTERVAL)
+            self._sampling = True
+        self._timeout = asyncio.get_running_loop().call_later(self.duration, self.stop)
+        self.log.info(f"started {mode} profiling for {self.duration:.0f}s")
+
+    def stop(self):
+        """Stop the running session, its results are kept until the next start()"""
+        if not self.running:
+            return
+        self._timeout.cancel()
+        if self._profile is not None:
+            self._profile.disable()
+            self._stats = pstats.Stats(self._profile)
+            self._profile = None
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+            self._sampling = False
+        self.duration = time.time() - self.started_at
+        self.log.info(f"stopped {self.mode} profiling after {self.duration:.0f}s")
+
+    def _sample(self, signum, frame):
+        """SIGPROF handler, counts the collapsed stack of the interrupted frame"""
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame, lineno=False))
+            frame = frame.f_back
+        if stack:
+            self._samples[";".join(reversed(stack))] += 1
+
+    def report(self, limit=40, sort="cumulative"):
+        """Text report of the last session"""
+        if self._stats is not None:
+            out = io.StringIO()
+            self._stats.stream = out
+            self._stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
+
+        total = sum(self._samples.values())
+        if not total:
+            return "no samples"
+        # innermost frame of a stack is where the time went
+        own = Counter()
+        for stack, count in self._samples.items():
+            own[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"{total} samples of {config.PROFILE_SAMPLE_INTERVAL}s CPU time in {self.duration:.1f}s", "",
+                 "own samples:"]
+        lines += [f"{100 * c / total:6.2f}% {c:8d}  {f}" for f, c in own.most_common(limit)]
+        lines += ["", "stacks:"]
+        lines += [f"{100 * c / total:6.2f}% {c:8d}  {s}" for s, c in self._samples.most_common(limit)]
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Write the last session to a file, pstats format for cprofile, collapsed stacks for sampling"""
+        if self._stats is not None:
+            self._stats.dump_stats(path)
+        else:
+            with open(path, "w") as f:
+                for stack, count in self._samples.most_common():
+                    f.write(f"{stack} {count}\n")
+
+
+class SlowCallbackLog(logging.Handler):
+    """Collects asyncio's slow callback warnings, which only exist in loop debug mode"""
+    def __init__(self, maxlen=100):
+        super().__init__(logging.WARNING)
+        self.records = deque(maxlen=maxlen)
+        self.threshold = None
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Executing"):
+            self.records.append({"time": record.created, "message": message})
+            registry.inc("web3chan_slow_callbacks_total")
+
+    def enable(self, threshold):
+        """Turn on loop debug mode and report callbacks that run longer than threshold seconds"""
+        loop = asyncio.get_running_loop()
+        loop.slow_callback_duration = threshold
+        loop.set_debug(True)
+        if self.threshold is None:
+            logging.getLogger("asyncio").addHandler(self)
+        self.threshold = threshold
+
+    def disable(self):
+        asyncio.get_running_loop().set_debug(False)
+        logging.getLogger("asyncio").removeHandler(self)
+        self.threshold = None
+
+
+def await_chain(task):
+    """Where a task is suspended, outermost coroutine first"""
+    chain = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            # a future or a finished coroutine
+            chain.append(type(coro).__name__)
+            break
+        chain.append(_frame_label(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return chain
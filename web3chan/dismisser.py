@@ -0,0 +1,96 @@
+import asyncio
+import logging
+
+from web3chan import config, scheduler
+
+
+class NotificationDismisser:
+    """Dismisses handled notifications of a board in batches
+
+    IDs are collected from the queue for up to DISMISS_BATCH_WINDOW seconds and
+    dismissed with at most DISMISS_CONCURRENCY requests in flight. When the backlog
+    is at least DISMISS_CLEAR_THRESHOLD long and there is nothing left to handle,
+    all notifications are cleared with a single request instead. That is only done
+    while the stream is connected, it delivers what arrives before the clear
+    request goes out, polling would lose it."""
+    def __init__(self, bot):
+        self.bot = bot
+        self.api = bot.api
+        self.queue = bot.dismiss_queue
+        self.log = logging.getLogger(f"Dismisser:{bot.board.name}")
+        self.semaphore = asyncio.Semaphore(config.DISMISS_CONCURRENCY)
+        self.dismissed = 0
+        self.failed = 0
+
+    @property
+    def pending(self):
+        return self.queue.qsize()
+
+    async def run(self):
+        scheduler.current_priority.set(scheduler.BACKGROUND)
+        while True:
+            batch = await self._collect()
+            backlog = len(batch) + self.pending
+            if backlog >= config.DISMISS_CLEAR_THRESHOLD > 0 and self.bot.stream_connected \
+                    and await self._backlog_handled() and self.bot.stream_connected:
+                await self._clear(batch)
+            else:
+                await asyncio.gather(*[self._dismiss(n) for n in batch])
+
+            self.log.debug(f"dismissed {self.dismissed}, failed {self.failed}, pending {self.pending}")
+
+    async def _collect(self):
+        """Wait for a notification and group everything that arrives within the batch window"""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.DISMISS_BATCH_WINDOW
+        while len(batch) < config.DISMISS_BATCH_SIZE:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _backlog_handled(self):
+        """True if every notification on the server has been handled already"""
+        if self.bot.cursor.pending:
+            return False
+        try:
+            newer = await self.api.notifications(params={"limit": 1, "since_id": self.bot.cursor.last_id,
+                                                         **self.bot.notification_filter()})
+        except Exception as e:
+            self.log.error(f"can't check for new notifications: {type(e)}: {e}")
+            return False
+        return not newer.data
+
+    async def _clear(self, batch):
+        self.log.debug(f"clearing all notifications, backlog of {len(batch) + self.pending}")
+        try:
+            await self.api.notifications_clear()
+        except Exception as e:
+            self.log.error(f"can't clear notifications: {type(e)}: {e}")
+            await asyncio.gather(*[self._dismiss(n) for n in batch])
+            return
+
+        # everything still in the queue has been handled and is gone from the server too
+        cleared = len(batch)
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            cleared += 1
+        self.dismissed += cleared
+
+    async def _dismiss(self, n):
+        async with self.semaphore:
+            try:
+                await self.api.notification_dismiss(n["id"])
+            except Exception as e:
+                self.failed += 1
+                self.log.error(f"can't dismiss notification {n['id']}: {type(e)}: {e}")
+            else:
+                self.dismissed += 1
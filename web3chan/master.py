@@ -1,28 +1,70 @@
+import os
 import asyncio
 import orjson
 import signal
 import logging
 
+from contextlib import suppress
+
 import httpx
-import orm.exceptions
 from aroma.api import MastodonAPI, ResponseList
 
-from web3chan import config, db, rpc
+from web3chan import config, db, rpc, cluster, metrics, diagnostics
+from web3chan.scheduler import SchedulingTransport
 from web3chan.board import BoardBot
+from web3chan.registry import BoardRegistry, board_state
+from web3chan.timers import TimerWheel
+from web3chan.utils import HashRing
 
 
 class BotMaster:
     __RPC_METHODS__ = ("help", "healthcheck",
-                       "add_board", "remove_board", "list_boards", "toggle_board_option",
+                       "add_board", "add_boards", "remove_board", "list_boards", "toggle_board_option",
                        "start_board", "stop_board", "restart_board",
+                       "refresh_board", "reload", "startup_status", "pool_stats", "metrics", "prometheus",
+                       "list_timers", "set_timer_interval",
+                       "profile_start", "profile_stop", "slow_callbacks", "list_tasks",
                        "mastoapi")
 
-    def __init__(self):
+    def __init__(self, shard=None):
         self.log = logging.getLogger("BotMaster")
-        self.client = httpx.AsyncClient()
+        # (index, count) of this worker process, see web3chan.sharding
+        self.shard = shard
+        self.ring = HashRing(range(shard[1])) if shard else None
+        # workers exit when the master that started them is gone
+        self.parent_pid = os.getppid() if shard else None
+        # every instance gets its own connection pool, see scheduler.instance_transport
+        self.transport = SchedulingTransport()
+        self.client = httpx.AsyncClient(
+            transport=self.transport,
+            timeout=httpx.Timeout(config.HTTP_TIMEOUT, pool=config.HTTP_POOL_TIMEOUT)
+        )
         self.stop_event = asyncio.Event()
         self.rpc_server = None
+        self.boards = BoardRegistry()
+        # names of boards being added
+        self.adding = set()
         self.slaves = {}
+        self.starting = set()
+        self.failed = set()
+        self.reload_lock = asyncio.Lock()
+        self.reload_tasks = set()
+        self.startup_semaphore = asyncio.Semaphore(config.STARTUP_CONCURRENCY)
+        # created with the event loop running, asyncio primitives bind to a loop before Python 3.10
+        self.handler_semaphore = asyncio.Semaphore(config.HANDLER_GLOBAL_CONCURRENCY)
+        self.instance_semaphores = {}
+        self.leases = cluster.LeaseManager(self) if config.CLUSTER else None
+        self.lease_task = None
+        # loop lag monitor, metrics server and parent watch, cancelled on shutdown
+        self.service_tasks = []
+        self.timers = TimerWheel()
+        self.timers_task = None
+        self.profiler = diagnostics.Profiler()
+        self.slow_callback_log = diagnostics.SlowCallbackLog()
+        metrics.registry.gauge("web3chan_notif_queue_depth",
+                               lambda: {(("board", k),): len(s.cursor.pending) for k, s in self.slaves.items()})
+        metrics.registry.gauge("web3chan_dismiss_queue_depth",
+                               lambda: {(("board", k),): s.dismiss_queue.qsize() for k, s in self.slaves.items()})
 
     async def start(self):
         """"Main function"""
@@ -31,26 +73,75 @@ class BotMaster:
         except Exception as e:
             self.log.error(f"can't connect to the database: {e}")
             return
+        await self.boards.load()
+
+        self.service_tasks.append(asyncio.create_task(metrics.loop_lag_monitor()))
+        if config.METRICS_ADDRESS:
+            async def render():
+                return (await self.prometheus())["result"]
+            self.service_tasks.append(asyncio.create_task(metrics.serve_prometheus(config.METRICS_ADDRESS, render)))
 
+        self.timers_task = asyncio.create_task(self.timers.run())
+        if self.parent_pid:
+            self.service_tasks.append(asyncio.create_task(self._watch_parent()))
         await self.start_slaves()
         await self.start_rpc()
         self.log.info("started")
 
-        # catch sigint for graceful shutdown
-        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.stop_event.set)
+        # catch sigint and sigterm for graceful shutdown, sighup reloads boards from the database
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop_event.set)
+        loop.add_signal_handler(signal.SIGTERM, self.stop_event.set)
+        loop.add_signal_handler(signal.SIGHUP, self._reload_on_signal)
         await self.stop_event.wait()
 
         await self.stop_rpc()
         await self.stop_slaves()
+        for t in self.service_tasks + [self.timers_task]:
+            t.cancel()
+            with suppress(asyncio.CancelledError):
+                await t
         await self.client.aclose()
         self.log.info("stopped")
 
+    async def _watch_parent(self):
+        """Stop the worker when the master process died, its workers run in sessions of their own"""
+        while os.getppid() == self.parent_pid:
+            await asyncio.sleep(config.WORKER_PARENT_CHECK_INTERVAL)
+        self.log.error("master process is gone, stopping")
+        self.stop_event.set()
+
+    def _reload_on_signal(self):
+        self.log.info("SIGHUP received, reloading boards")
+        task = asyncio.create_task(self.reload())
+        self.reload_tasks.add(task)
+        task.add_done_callback(self.reload_tasks.discard)
+
+    def owns(self, name):
+        """True if the board is assigned to this process"""
+        if self.shard is None:
+            return True
+        return self.ring.node_for(name) == self.shard[0]
+
     async def start_slaves(self):
-        boards = await db.Board.objects.select_related("instance").filter(enabled=True).all()
-        await asyncio.gather(*[self.start_board(b.name) for b in boards])
+        if self.leases:
+            # boards are started as their leases are claimed
+            self.lease_task = asyncio.create_task(self.leases.run())
+            return
+        boards = [b for b in self.boards.all() if b.enabled]
+        # boards that fail to start are in self.failed, they don't stop the others
+        await asyncio.gather(*[self.start_board(b.name) for b in boards if self.owns(b.name)],
+                             return_exceptions=True)
+        self.log.info(f"started {len(self.slaves)} boards, {len(self.failed)} failed")
 
     async def stop_slaves(self):
-        await asyncio.gather(*[self.stop_board(k) for k in self.slaves.keys()])
+        if self.lease_task:
+            self.lease_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.lease_task
+        await asyncio.gather(*[self.stop_slave(k) for k in list(self.slaves.keys())])
+        if self.leases:
+            await self.leases.stop()
 
     async def start_rpc(self):
         self.rpc_server = asyncio.create_task(self.__rpc_server())
@@ -59,62 +150,119 @@ class BotMaster:
         self.rpc_server.cancel()
         await self.rpc_server
 
+    async def __rpc_call(self, request):
+        """Execute a single JSON-RPC request, returns the response object"""
+        response = {"jsonrpc": "2.0"}
+        if type(request) != dict or request.get("jsonrpc") != "2.0" or "method" not in request or "id" not in request:
+            response_data = rpc.INVALID_REQUEST
+        else:
+            response.update({"id": request["id"]})
+
+            if request["method"] in self.__RPC_METHODS__:
+                args, kwargs = (), {}
+                if "params" in request:
+                    if "args" in request["params"] and type(request["params"]["args"]) == list:
+                        args = request["params"]["args"]
+                    if "kwargs" in request["params"] and type(request["params"]["kwargs"]) == dict:
+                        kwargs = request["params"]["kwargs"]
+
+                try:
+                    self.log.debug(f"JSON-RPC method called: {request['method']} {args} {kwargs}")
+                    response_data = await getattr(self, request["method"])(*args, **kwargs)
+                except Exception as e:
+                    self.log.error(f"error while executing RPC method: {type(e)}: {e}")
+                    response_data = rpc.INTERNAL_ERROR
+
+                if "result" in response_data:
+                    if type(response_data["result"]) == ResponseList:
+                        # TODO: json serialize ResponseList
+                        response_data["result"] = response_data["result"].data
+
+            else:
+                response_data = rpc.METHOD_NOT_FOUND
+
+        response.update(response_data)
+        return response
+
+    async def __rpc_line(self, data):
+        """Execute a request line, a single request or a batch array"""
+        try:
+            request = orjson.loads(data)
+        except Exception as e:
+            self.log.error(f"RPC command parser exception: {(type(e))}: {e}")
+            return dict({"jsonrpc": "2.0"}, **rpc.PARSE_ERROR)
+
+        if type(request) == list:
+            if not request:
+                return dict({"jsonrpc": "2.0"}, **rpc.INVALID_REQUEST)
+            return await asyncio.gather(*[self.__rpc_call(r) for r in request])
+        return await self.__rpc_call(request)
+
     async def __rpc_server(self):
-        """JSON-RPC server loop"""
+        """JSON-RPC server loop
+
+        Connections stay open, every line is a request or a batch array. Pipelined
+        requests are executed concurrently, responses are written as they complete."""
         async def handle_rpc_client(reader, writer):
-            request, response = None, {"jsonrpc": "2.0"}
+            semaphore = asyncio.Semaphore(config.RPC_PIPELINE_CONCURRENCY)
+            tasks = set()
+
+            async def respond(data):
+                try:
+                    response = await self.__rpc_line(data)
+                    writer.write(orjson.dumps(response) + b"\n")
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+                finally:
+                    semaphore.release()
 
-            data = await reader.readline()
             try:
-                request = orjson.loads(data)
-            except Exception as e:
-                self.log.error(f"RPC command parser exception: {(type(e))}: {e}")
-
-            if request is None:
-                response_data = rpc.PARSE_ERROR
-            elif "jsonrpc" not in request or request["jsonrpc"] != "2.0" or "method" not in request or "id" not in request:
-                response_data = rpc.INVALID_REQUEST
-            else:
-                response.update({"id": request["id"]})
-
-                if request["method"] in self.__RPC_METHODS__:
-                    args, kwargs = (), {}
-                    if "params" in request:
-                        if "args" in request["params"] and type(request["params"]["args"]) == list:
-                            args = request["params"]["args"]
-                        if "kwargs" in request["params"] and type(request["params"]["kwargs"]) == dict:
-                            kwargs = request["params"]["kwargs"]
-
-                    try:
-                        self.log.debug(f"JSON-RPC method called: {request['method']} {args} {kwargs}")
-                        response_data = await getattr(self, request["method"])(*args, **kwargs)
-                    except Exception as e:
-                        self.log.error(f"error while executing RPC method: {type(e)}: {e}")
-                        response_data = rpc.INTERNAL_ERROR
-
-                    if "result" in response_data:
-                        if type(response_data["result"]) == ResponseList:
-                            # TODO: json serialize ResponseList
-                            response_data["result"] = response_data["result"].data
-
-                else:
-                    response_data = rpc.METHOD_NOT_FOUND
-
-            response.update(response_data)
-            writer.write(orjson.dumps(response))
-            writer.close()
-            await writer.wait_closed()
-
+                while True:
+                    data = await reader.readline()
+                    if not data:
+                        break
+                    if not data.strip():
+                        continue
+                    await semaphore.acquire()
+                    task = asyncio.create_task(respond(data))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            except (ConnectionError, ValueError) as e:
+                self.log.debug(f"RPC connection error: {type(e)}: {e}")
+            finally:
+                if tasks:
+                    await asyncio.gather(*tasks)
+                writer.close()
+                with suppress(ConnectionError):
+                    await writer.wait_closed()
+
+        servers = []
         host, port = config.RPC_ADDRESS.split(":")
-        # TODO: handle bind exceptions
-        server = await asyncio.start_server(handle_rpc_client, host, int(port))
+        try:
+            servers.append(await asyncio.start_server(handle_rpc_client, host, int(port),
+                                                      limit=config.RPC_MAX_LINE))
+        except OSError as e:
+            # most likely another daemon or a leftover worker runs on this address, don't run boards twice
+            self.log.error(f"can't start JSON-RPC server on {host}:{port}, stopping: {type(e)}: {e}")
+            self.stop_event.set()
+            return
         self.log.info(f"running JSON-RPC server on: {host}:{port}")
 
+        if config.RPC_SOCKET:
+            with suppress(FileNotFoundError):
+                os.unlink(config.RPC_SOCKET)
+            servers.append(await asyncio.start_unix_server(handle_rpc_client, config.RPC_SOCKET,
+                                                           limit=config.RPC_MAX_LINE))
+            self.log.info(f"running JSON-RPC server on: {config.RPC_SOCKET}")
+
         try:
-            async with server:
-                await server.serve_forever()
+            await asyncio.gather(*[s.serve_forever() for s in servers])
         except asyncio.CancelledError:
             pass
+        finally:
+            for s in servers:
+                s.close()
 
     async def help(self):
         """help - returns this help message"""
@@ -133,23 +281,26 @@ class BotMaster:
 
         arguments: name, base_url, email, password"""
         self.log.info(f"adding board: {name}, {base_url}")
-        # check if a board with that name already exists
-        board = await db.Board.objects.filter(name=name).first()
-        if board:
+        # check if a board with that name is being added or already exists,
+        # the name is reserved before the first await so concurrent adds see it
+        if name in self.adding:
             return rpc.INTERNAL_ERROR
-
-        # get or create Instance object
+        self.adding.add(name)
         try:
-            instance = await db.Instance.objects.get(base_url=base_url)
-        except orm.exceptions.NoMatch:
-            try:
-                client_id, client_secret = await MastodonAPI.create_app(self.client, base_url)
-            except Exception as e:
-                self.log.error(f"add_board: can't create MastoAPI app: {type(e)}: {e}")
+            if await self.boards.get(name):
                 return rpc.INTERNAL_ERROR
-            else:
-                instance = await db.Instance.objects.create(base_url=base_url, client_id=client_id,
-                                                            client_secret=client_secret)
+            return await self._add_board(name, base_url, email, password)
+        finally:
+            self.adding.discard(name)
+
+    async def _add_board(self, name, base_url, email, password):
+        # get or create Instance object, the app is registered once per instance
+        try:
+            instance = await self.boards.get_or_create_instance(
+                base_url, lambda: MastodonAPI.create_app(self.client, base_url))
+        except Exception as e:
+            self.log.error(f"add_board: can't create MastoAPI app: {type(e)}: {e}")
+            return rpc.INTERNAL_ERROR
 
         # create Board object
         try:
@@ -162,35 +313,88 @@ class BotMaster:
             self.log.error(f"add_board: can't log in: {type(e)}: {e}")
             return rpc.INTERNAL_ERROR
 
-        board = await db.Board.objects.create(name=name, instance=instance, access_token=access_token,
-                                              enabled=True, streaming=config.STREAMING, 
-                                              autofollow=config.AUTOFOLLOW, replies=config.REPLIES)
+        try:
+            await self.boards.create_board(name, instance, access_token=access_token,
+                                           enabled=True, streaming=config.STREAMING,
+                                           autofollow=config.AUTOFOLLOW, replies=config.REPLIES)
+        except Exception as e:
+            self.log.error(f"add_board: can't save board: {type(e)}: {e}")
+            return rpc.INTERNAL_ERROR
         return rpc.OK
 
+    async def add_boards(self, boards, start=False):
+        """add_boards - add many boards concurrently, returns added and started status per board
+
+        arguments: boards (list of [name, base_url, email, password]), start (start every board once it's added)"""
+        start = start in (True, "True", "true", "1")
+        semaphore = asyncio.Semaphore(config.PROVISION_CONCURRENCY)
+        instance_semaphores = {}
+
+        async def provision(name, base_url, email, password):
+            instance_semaphore = instance_semaphores.setdefault(
+                base_url, asyncio.Semaphore(config.PROVISION_CONCURRENCY_PER_INSTANCE))
+            async with instance_semaphore, semaphore:
+                added = await self.add_board(name, base_url, email, password) == rpc.OK
+            started = None
+            # in cluster mode boards start wherever their lease goes
+            if added and start and not self.leases:
+                started = await self.start_board(name) == rpc.OK
+            return {"name": name, "added": added, "started": started}
+
+        try:
+            boards = [(b["name"], b["base_url"], b["email"], b["password"]) if type(b) == dict else tuple(b)
+                      for b in boards]
+            assert all(len(b) == 4 for b in boards), "every board needs name, base_url, email and password"
+        except Exception as e:
+            self.log.error(f"add_boards: invalid boards: {type(e)}: {e}")
+            return rpc.INVALID_PARAMS
+
+        self.log.info(f"adding {len(boards)} boards")
+        return {"result": await asyncio.gather(*[provision(*b) for b in boards])}
+
     async def remove_board(self, name):
         """remove_board
 
         arguments: name"""
-        try:
-            board = await db.Board.objects.get(name=name)
-            await board.delete()
-        except orm.exceptions.NoMatch:
+        board = await self.boards.get(name)
+        if board is None:
             return rpc.INTERNAL_ERROR
-        else:
-            return rpc.OK
+        # a stopping bot flushes its cursor and outbox, stop it before its rows are deleted
+        await self._stop_everywhere(board)
+        # SQLite doesn't cascade without PRAGMA foreign_keys, and reuses the board id for the next board
+        async with db.database.transaction():
+            for model in (db.Follower, db.Following, db.NotificationCursor, db.SpilledNotification, db.Action):
+                await model.objects.filter(board=board).delete()
+            await self.boards.delete_board(board)
+        await db.BoardLease.objects.filter(board_name=name).delete()
+        return rpc.OK
+
+    async def _stop_everywhere(self, board):
+        """Stop a board wherever it runs"""
+        await self.stop_slave(board.name)
+        if config.CLUSTER:
+            # the node running it stops a disabled board on its next rebalance and releases the lease
+            await self.boards.update_board(board, enabled=False)
+            await cluster.wait_released(board.name, config.NODE_ID, config.LEASE_TTL + config.LEASE_RENEW_INTERVAL)
 
     async def list_boards(self):
-        """list_boards - returns a list of all boards hosted on this web3chan node"""
-        boards = await db.Board.objects.all()
-        return {"result": [(b.name, b.enabled, b.name in self.slaves, b.streaming, b.autofollow, b.replies) for b in boards]}
+        """list_boards - returns a list of all boards hosted on this web3chan node
+
+        the last column is the node that runs the board"""
+        boards = self.boards.all()
+        if config.CLUSTER:
+            owners = await cluster.lease_owners()
+        else:
+            owners = {name: config.NODE_ID for name in self.slaves}
+        return {"result": [(b.name, b.enabled, b.name in self.slaves, b.streaming, b.autofollow, b.replies,
+                            owners.get(b.name)) for b in boards]}
 
     async def toggle_board_option(self, name, field):
-        """toggle_board_option - toggle boolean option in the database
+        """toggle_board_option - toggle boolean option in the database and apply it to the running board
 
         arguments: name, field"""
-        try:
-            board = await db.Board.objects.get(name=name)
-        except orm.exceptions.NoMatch:
+        board = await self.boards.get(name)
+        if board is None:
             return rpc.INTERNAL_ERROR
         try:
             value = getattr(board, field)
@@ -201,25 +405,205 @@ class BotMaster:
 
         # update field with an opposite value
         updated_vals = {field: not value}
-        await board.update(**updated_vals)
+        old = board_state(board)
+        await self.boards.update_board(board, **updated_vals)
+        await self.apply_changes(name, old)
+        return rpc.OK
+
+    async def refresh_board(self, name):
+        """refresh_board - re-read board settings from the database and apply them to the running board
+
+        arguments: name"""
+        board = self.boards.boards.get(name)
+        old = board_state(board) if board else None
+        board = await self.boards.refresh(name)
+        await self.apply_changes(name, old)
+        return rpc.OK if board else rpc.INTERNAL_ERROR
+
+    async def reload(self):
+        """reload - re-read all boards from the database and apply what changed, also done on SIGHUP
+
+        added and enabled boards are started, removed and disabled boards stopped, boards with new
+        credentials restarted, other options are applied to running boards without restarting them"""
+        async with self.reload_lock:
+            old = {name: board_state(b) for name, b in self.boards.boards.items()}
+            try:
+                await self.boards.load()
+            except Exception as e:
+                self.log.error(f"reload: can't load boards: {type(e)}: {e}")
+                return rpc.INTERNAL_ERROR
+
+            names = list(old.keys() | self.boards.boards.keys() | self.slaves.keys())
+            changes = await asyncio.gather(*[self.apply_changes(name, old.get(name)) for name in names])
+
+        result = {}
+        for name, change in zip(names, changes):
+            if change:
+                result.setdefault(change[0], {})[name] = change[1]
+        summary = ", ".join(f"{len(v)} {k}" for k, v in result.items())
+        self.log.info(f"reloaded boards: {summary or 'no changes'}")
+        return {"result": result}
+
+    async def apply_changes(self, name, old):
+        """Bring a board of this process in line with its cached row, old is its state before the row changed
+
+        returns (action, changed fields) or None if nothing was done"""
+        board = self.boards.boards.get(name)
+        bot = self.slaves.get(name)
+        new = board_state(board) if board else None
+        if new == old and (bot is None or bot.board is board):
+            return None
+        # added and removed boards have no changed fields
+        changed = sorted(f for f in new if old[f] != new[f]) if old and new else []
+
+        if board is None and self.leases:
+            # removed, a new board of the same name mustn't stay paused
+            self.leases.paused.discard(name)
+        # with clustering boards are started and stopped as their leases move
+        if board is None or not board.enabled or not self.owns(name):
+            if bot is None or self.leases:
+                return None
+            await self.stop_slave(name)
+            return "stopped", changed
+
+        if bot is None:
+            if self.leases or name in self.starting or (old and "enabled" not in changed):
+                return None
+            result = await self.start_board(name)
+            return ("started" if result == rpc.OK else "failed"), changed
+
+        if bot.board is not board or "access_token" in changed or "base_url" in changed:
+            # the board was recreated or got new credentials, the API client has to be rebuilt
+            await self.stop_slave(name)
+            result = await self.start_board(name)
+            return ("restarted" if result == rpc.OK else "failed"), changed
+
+        # autofollow and replies are read from the shared Board object on every notification
+        if "streaming" in changed:
+            await bot.set_streaming(board.streaming)
+        bot.log.info(f"options changed: {', '.join(changed)}")
+        return "updated", changed
+
+    async def startup_status(self):
+        """startup_status - returns boards that are starting, syncing relationships or failed to start"""
+        syncing = [name for name, s in self.slaves.items() if s.state == "syncing"]
+        return {"result": {"running": len(self.slaves) - len(syncing), "syncing": syncing,
+                           "starting": sorted(self.starting), "failed": sorted(self.failed)}}
+
+    async def pool_stats(self):
+        """pool_stats - returns connection pool and request scheduler stats per instance"""
+        return {"result": self.transport.stats()}
+
+    async def metrics(self):
+        """metrics - returns counters, gauges and latency histograms of this process"""
+        return {"result": metrics.registry.snapshot()}
+
+    async def prometheus(self):
+        """prometheus - returns metrics of this process in Prometheus text format"""
+        return {"result": metrics.registry.prometheus()}
+
+    async def list_timers(self):
+        """list_timers - returns periodic board jobs (fetcher, relationships, cursor) and interval overrides"""
+        return {"result": self.timers.stats()}
+
+    async def set_timer_interval(self, kind, seconds=None, name=None):
+        """set_timer_interval - change the interval of a kind of periodic job at runtime
+
+        arguments: kind, seconds (omit to go back to the default), name (omit for all boards)"""
+        if kind not in ("fetcher", "relationships", "cursor"):
+            return rpc.INTERNAL_ERROR
+        seconds = float(seconds) if seconds is not None else None
+        return {"result": self.timers.set_interval(kind, seconds, name)}
+
+    async def profile_start(self, mode="sampling", duration=60):
+        """profile_start - start profiling the event loop, stops by itself after duration seconds
+
+        arguments: mode (sampling or cprofile), duration"""
+        try:
+            self.profiler.start(mode, float(duration))
+        except (RuntimeError, ValueError) as e:
+            self.log.error(f"profile_start: {type(e)}: {e}")
+            return rpc.INTERNAL_ERROR
         return rpc.OK
 
+    async def profile_stop(self, limit=40, sort="cumulative", dump=None):
+        """profile_stop - stop profiling, returns a report of the top functions or writes stats to a file
+
+        arguments: limit, sort (cprofile sort key), dump (path of the stats file on the daemon host)"""
+        if self.profiler.mode is None:
+            return rpc.INTERNAL_ERROR
+        self.profiler.stop()
+        if dump:
+            try:
+                self.profiler.dump(dump)
+            except OSError as e:
+                self.log.error(f"profile_stop: can't dump stats: {type(e)}: {e}")
+                return rpc.INTERNAL_ERROR
+            return {"result": dump}
+        return {"result": self.profiler.report(int(limit), sort)}
+
+    async def slow_callbacks(self, threshold=None):
+        """slow_callbacks - report callbacks that block the event loop, returns the recent ones
+
+        arguments: threshold (seconds, 0 turns detection off, omit to keep the current setting)"""
+        if threshold is not None:
+            threshold = float(threshold)
+            if threshold > 0:
+                self.slow_callback_log.enable(threshold)
+            else:
+                self.slow_callback_log.disable()
+        return {"result": {"threshold": self.slow_callback_log.threshold,
+                           "callbacks": list(self.slow_callback_log.records)}}
+
+    async def list_tasks(self, name=None):
+        """list_tasks - returns live asyncio tasks per board with the point they are waiting at
+
+        arguments: name (omit for all boards)"""
+        tasks = {}
+        for task in asyncio.all_tasks():
+            board, _, job = task.get_name().rpartition("/")
+            if board not in self.slaves:
+                board, job = "master", task.get_name()
+            if name is None or board == name:
+                tasks.setdefault(board, []).append({"task": job, "await": diagnostics.await_chain(task)})
+        return {"result": tasks}
+
     async def start_board(self, name):
         """start_board
 
         arguments: name"""
         self.log.debug(f"starting BoardBot: {name}")
-        if name in self.slaves:
+        if name in self.slaves or name in self.starting:
             return rpc.INTERNAL_ERROR
-        try:
-            board = await db.Board.objects.select_related("instance").get(name=name)
-        except orm.exceptions.NoMatch:
+        if self.leases:
+            self.leases.paused.discard(name)
+            if not await self.leases.holds(name):
+                self.log.error(f"start_board: {name} is not leased to this node, it starts wherever it's leased")
+                return rpc.INTERNAL_ERROR
+        board = await self.boards.get(name)
+        if board is None:
             return rpc.INTERNAL_ERROR
 
-        s = BoardBot(self.client, board)
-        result = await s.start()
+        base_url = board.instance.base_url
+        if base_url not in self.instance_semaphores:
+            self.instance_semaphores[base_url] = asyncio.Semaphore(config.STARTUP_CONCURRENCY_PER_INSTANCE)
+
+        self.starting.add(name)
+        self.failed.discard(name)
+        try:
+            async with self.instance_semaphores[base_url], self.startup_semaphore:
+                s = BoardBot(self.client, board, self.timers, self.handler_semaphore)
+                result = await s.start()
+        except Exception as e:
+            self.log.error(f"start_board: can't start {name}: {type(e)}: {e}")
+            result = rpc.INTERNAL_ERROR
+        finally:
+            self.starting.discard(name)
+
         if result == rpc.OK:
             self.slaves[board.name] = s
+        else:
+            self.failed.add(name)
 
         return result
 
@@ -229,10 +613,15 @@ class BotMaster:
         arguments: name"""
         if name not in self.slaves:
             return rpc.INTERNAL_ERROR
-        await self.slaves[name].stop()
-        del self.slaves[name]
+        if self.leases:
+            self.leases.paused.add(name)
+        await self.stop_slave(name)
         return rpc.OK
 
+    async def stop_slave(self, name):
+        if name in self.slaves:
+            await self.slaves.pop(name).stop()
+
     async def restart_board(self, name):
         """restart_board
 
@@ -244,12 +633,14 @@ class BotMaster:
         """mastoapi - execute MastoAPI method with a board account, returns API response
 
         arguments: name, method, *args, **kwargs"""
-        try:
-            board = await db.Board.objects.select_related("instance").get(name=name)
-        except orm.exceptions.NoMatch:
-            return rpc.INTERNAL_ERROR
-
-        api = MastodonAPI(self.client, board.instance.base_url, access_token=board.access_token)
+        if name in self.slaves:
+            # the running bot's API client
+            api = self.slaves[name].api
+        else:
+            board = await self.boards.get(name)
+            if board is None:
+                return rpc.INTERNAL_ERROR
+            api = MastodonAPI(self.client, board.instance.base_url, access_token=board.access_token)
 
         if method not in dir(api):
             return rpc.INTERNAL_ERROR
@@ -0,0 +1,162 @@
+import asyncio
+import bisect
+import logging
+import re
+import time
+
+from web3chan import config
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float("inf"))
+
+_ID_RE = re.compile(r"/(\d+|[0-9A-Za-z]{16,})(?=/|$)")
+
+
+def endpoint(method, path):
+    """Metric label of an API request, object ids are replaced with :id"""
+    return f"{method} {_ID_RE.sub('/:id', path)}"
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Histogram:
+    """Fixed bucket histogram, observe() is a bisect and two additions"""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total, result = 0, []
+        for le, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((le, total))
+        return result
+
+    def percentile(self, q):
+        """Upper bound of the bucket that contains the q-th percentile"""
+        rank = q * self.count
+        for le, total in self.cumulative():
+            if total >= rank:
+                return le
+        return float("inf")
+
+
+class Registry:
+    """Counters and histograms keyed by (name, labels), gauges are read on demand"""
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, fn):
+        """Register a gauge, fn returns a dict of labels to values"""
+        self.gauges[name] = fn
+
+    def _gauge_values(self):
+        for name, fn in self.gauges.items():
+            for labels, value in fn().items():
+                yield name, labels, value
+
+    def snapshot(self):
+        histograms = {}
+        for (name, labels), h in self.histograms.items():
+            histograms[_series(name, labels)] = {
+                "count": h.count, "sum": h.sum,
+                "p50": h.percentile(0.5), "p90": h.percentile(0.9), "p99": h.percentile(0.99)
+            }
+        return {
+            "counters": {_series(name, labels): v for (name, labels), v in self.counters.items()},
+            "gauges": {_series(name, labels): v for name, labels, v in self._gauge_values()},
+            "histograms": histograms
+        }
+
+    def prometheus(self):
+        """Metrics in Prometheus text exposition format"""
+        lines = []
+        for (name, labels), v in sorted(self.counters.items()):
+            lines.append(f"{_series(name, labels)} {v}")
+        for name, labels, v in self._gauge_values():
+            lines.append(f"{_series(name, labels)} {v}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            for le, total in h.cumulative():
+                le = "+Inf" if le == float("inf") else le
+                lines.append(f"{_series(name + '_bucket', labels + (('le', le),))} {total}")
+            lines.append(f"{_series(name + '_sum', labels)} {h.sum}")
+            lines.append(f"{_series(name + '_count', labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def with_label(text, key, value):
+    """Add a label to every series of Prometheus text, to merge the metrics of several processes"""
+    lines = []
+    for line in text.splitlines():
+        if not line:
+            continue
+        # label values may contain spaces, the value itself doesn't
+        series, _, v = line.rpartition(" ")
+        if series.endswith("}"):
+            series = series[:-1] + f',{key}="{value}"}}'
+        else:
+            series += f'{{{key}="{value}"}}'
+        lines.append(f"{series} {v}")
+    return "\n".join(lines) + "\n"
+
+
+async def loop_lag_monitor():
+    """Task that measures how late the event loop wakes up"""
+    interval = config.METRICS_LOOP_LAG_INTERVAL
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        registry.observe("web3chan_event_loop_lag_seconds", max(time.monotonic() - started - interval, 0))
+
+
+async def serve_prometheus(address, render=None):
+    """Serve registry.prometheus() over plain HTTP, or the text returned by the render coroutine"""
+    log = logging.getLogger("Metrics")
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = (await render() if render else registry.prometheus()).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    host, port = address.split(":")
+    server = await asyncio.start_server(handle, host, int(port))
+    log.info(f"serving Prometheus metrics on: {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import time
+
+from web3chan import config, db, scheduler
+from web3chan.cache import TTLCache
+from web3chan.metrics import registry
+
+REBLOG, FOLLOW = "reblog", "follow"
+PENDING, DONE, FAILED = "pending", "done", "failed"
+# type of the notification that leads to an action, for the latency metric
+NOTIFICATION_TYPES = {REBLOG: "mention", FOLLOW: "follow"}
+COLUMNS = ("key", "kind", "target_id", "label", "attempts")
+
+
+class ActionOutbox:
+    """Durable queue of the reblogs and follows of a board
+
+    plan() returns once the action is in the database, the writes of concurrent
+    plan() calls and of state changes are grouped into one transaction per
+    OUTBOX_FLUSH_WINDOW. Executors run actions with exponential backoff retries.
+    Planning an action that is pending already is a no-op. A status is reblogged
+    at most once per OUTBOX_RETENTION, an account can be followed again once the
+    earlier follow finished, it may have been undone since. An action interrupted
+    by a restart before it was marked done runs again, reblog and follow are
+    idempotent."""
+    def __init__(self, bot):
+        self.bot = bot
+        self.board = bot.board
+        self.log = logging.getLogger(f"Outbox:{bot.board.name}")
+        # keys of pending actions and of finished reblogs
+        self.pending = set()
+        self.finished = TTLCache(config.OUTBOX_RETENTION, config.OUTBOX_KEYS_CACHE_SIZE)
+        self.ready = asyncio.Queue()
+        self._inserts = []
+        self._done = []
+        self._updates = []
+        self._wakeup = asyncio.Event()
+        self._retries = set()
+        # plan() only waits for a writer that is running
+        self.writing = False
+        self._pruned_at = time.monotonic()
+
+    def _key(self, kind, target_id):
+        return f"{self.board.id}:{kind}:{target_id}"
+
+    async def load(self):
+        """Forget old finished actions and queue the pending ones"""
+        await self.prune()
+        now = time.time()
+        for row in await db.Action.objects.filter(board=self.board).all():
+            if row.state == PENDING:
+                self.pending.add(row.key)
+                self.ready.put_nowait({"key": row.key, "kind": row.kind, "target_id": row.target_id,
+                                       "label": row.label, "attempts": row.attempts})
+            elif row.kind == REBLOG:
+                self.finished.set(row.key, True, ttl=row.updated_at + config.OUTBOX_RETENTION - now)
+
+    async def prune(self):
+        """Delete finished actions older than OUTBOX_RETENTION"""
+        cutoff = time.time() - config.OUTBOX_RETENTION
+        await db.Action.objects.filter(board=self.board, state__in=[DONE, FAILED], updated_at__lt=cutoff).delete()
+        self._pruned_at = time.monotonic()
+
+    async def plan(self, kind, target_id, label, received_at=None):
+        """Record an action, returns False if it is pending or was done before
+
+        received_at is the loop time the notification arrived at, for the latency metric"""
+        if not self.writing:
+            raise RuntimeError("outbox writer is not running")
+        key = self._key(kind, target_id)
+        if key in self.pending or key in self.finished:
+            registry.inc("web3chan_actions_total", (("kind", kind), ("result", "duplicate")))
+            return False
+        self.pending.add(key)
+        saved = asyncio.get_running_loop().create_future()
+        self._inserts.append(({"key": key, "kind": kind, "target_id": target_id, "label": label, "attempts": 0,
+                               "received_at": received_at}, saved))
+        self._wakeup.set()
+        await saved
+        return True
+
+    async def run(self):
+        tasks = [asyncio.create_task(self._supervise(self._writer), name=f"{self.board.name}/outbox_writer")]
+        tasks += [asyncio.create_task(self._supervise(self._executor), name=f"{self.board.name}/outbox_executor{i}")
+                  for i in range(config.OUTBOX_CONCURRENCY)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for handle in self._retries:
+                handle.cancel()
+
+    async def _supervise(self, job):
+        """Run the writer or an executor, restart it if it crashes"""
+        while True:
+            try:
+                await job()
+            except Exception as e:
+                self.log.error(f"{job.__name__} crashed, restarting: {type(e)}: {e}")
+                await asyncio.sleep(1)
+
+    async def _writer(self):
+        self.writing = True
+        try:
+            while True:
+                await self._wakeup.wait()
+                await asyncio.sleep(config.OUTBOX_FLUSH_WINDOW)
+                self._wakeup.clear()
+                await self.flush()
+                # the table only grows while actions are written, prune along the way
+                if time.monotonic() - self._pruned_at > config.OUTBOX_PRUNE_INTERVAL:
+                    try:
+                        await self.prune()
+                    except Exception as e:
+                        self.log.error(f"can't prune actions: {type(e)}: {e}")
+                        self._pruned_at = time.monotonic()
+        finally:
+            self.writing = False
+
+    async def flush(self):
+        """Write planned actions and state changes in one transaction"""
+        inserts, self._inserts = self._inserts, []
+        done, self._done = self._done, []
+        updates, self._updates = self._updates, []
+        if not (inserts or done or updates):
+            return
+
+        now = time.time()
+        try:
+            async with db.database.transaction():
+                # state changes first, a follow planned again replaces the row of the earlier one
+                for chunk in db.chunks(done):
+                    await db.Action.objects.filter(key__in=chunk).update(state=DONE, updated_at=now)
+                for key, fields in updates:
+                    await db.Action.objects.filter(key=key).update(updated_at=now, **fields)
+                for chunk in db.chunks([action["key"] for action, _ in inserts]):
+                    await db.Action.objects.filter(key__in=chunk).delete()
+                await db.insert_many(db.Action, [dict({c: action[c] for c in COLUMNS}, board=self.board.id,
+                                                      state=PENDING, updated_at=now) for action, _ in inserts])
+        except Exception as e:
+            self.log.error(f"can't save actions: {type(e)}: {e}")
+            for action, saved in inserts:
+                self.pending.discard(action["key"])
+                if not saved.done():
+                    saved.set_exception(e)
+            # state changes go with the next batch
+            self._done = done + self._done
+            self._updates = updates + self._updates
+            return
+
+        for action, saved in inserts:
+            if not saved.done():
+                saved.set_result(None)
+            self.ready.put_nowait(action)
+
+    async def _executor(self):
+        while True:
+            action = await self.ready.get()
+            await self._execute(action)
+
+    async def _execute(self, action):
+        kind, label = action["kind"], action["label"]
+        try:
+            with scheduler.priority(scheduler.HIGH):
+                if kind == REBLOG:
+                    await self.bot.api.status_reblog(action["target_id"])
+                    self.log.info(f"reblogged {label}")
+                else:
+                    relationship = await self.bot.api.account_follow(action["target_id"])
+                    if relationship["following"]:
+                        await self.bot.relationships.add_following(action["target_id"])
+                        self.log.info(f"followed {label}")
+        except Exception as e:
+            # API errors, timeouts and database errors alike, the action is retried
+            action["attempts"] += 1
+            if action["attempts"] >= config.OUTBOX_MAX_ATTEMPTS:
+                self.log.error(f"can't {kind} {label}, giving up: {type(e)}: {e}")
+                self._updates.append((action["key"], {"state": FAILED, "attempts": action["attempts"]}))
+                self._finished(action)
+                result = "failed"
+            else:
+                delay = config.OUTBOX_RETRY_DELAY * 2 ** (action["attempts"] - 1)
+                self.log.warning(f"can't {kind} {label}, retrying in {delay:.0f}s: {type(e)}: {e}")
+                self._updates.append((action["key"], {"attempts": action["attempts"]}))
+                self._retry_later(action, delay)
+                result = "retry"
+        else:
+            self._done.append(action["key"])
+            self._finished(action)
+            if action.get("received_at") is not None:
+                registry.observe("web3chan_notification_latency_seconds", time.monotonic() - action["received_at"],
+                                 (("type", NOTIFICATION_TYPES[kind]),))
+            result = "done"
+
+        registry.inc("web3chan_actions_total", (("kind", kind), ("result", result)))
+        self._wakeup.set()
+
+    def _finished(self, action):
+        self.pending.discard(action["key"])
+        if action["kind"] == REBLOG:
+            self.finished.set(action["key"], True)
+
+    def _retry_later(self, action, delay):
+        def retry():
+            self._retries.discard(handle)
+            self.ready.put_nowait(action)
+        handle = asyncio.get_running_loop().call_later(delay, retry)
+        self._retries.add(handle)
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+
+from collections import deque
+
+import orjson
+
+from web3chan import db
+
+BLOCK, DROP_FOLLOWS, SPILL = "block", "drop_follows", "spill"
+POLICIES = (BLOCK, DROP_FOLLOWS, SPILL)
+
+
+class NotificationQueue:
+    """Bounded FIFO queue of notifications with an overflow policy
+
+    block        - put() waits until there is free space
+    drop_follows - the oldest queued follow notification is dropped to make room,
+                   put() waits if there is none
+    spill        - overflowing notifications are written to the database and read
+                   back once the queue is half empty, on_drained is called when
+                   everything spilled has been read back"""
+    def __init__(self, board, maxsize, policy=BLOCK, on_drop=None, on_drained=None):
+        if policy not in POLICIES:
+            raise ValueError(f"invalid overflow policy: {policy}")
+        self.board = board
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self.on_drained = on_drained
+        self.log = logging.getLogger(f"NotificationQueue:{board.name}")
+        self.items = deque()
+        self.spilled = 0
+        self._cond = asyncio.Condition()
+        self._refill_lock = asyncio.Lock()
+
+    def qsize(self):
+        return len(self.items) + self.spilled
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return len(self.items) >= self.maxsize
+
+    async def clear_spilled(self):
+        """Forget notifications spilled by a previous run, they are fetched again"""
+        await db.SpilledNotification.objects.filter(board=self.board).delete()
+
+    async def put(self, n):
+        if self.policy == SPILL and (self.spilled or self.full()):
+            # once something is spilled everything goes to the database, to keep the order
+            await self._spill(n)
+            return
+
+        async with self._cond:
+            while self.full():
+                if self.policy == DROP_FOLLOWS and self._drop_follow(n):
+                    if n.get("type") == "follow" and self.full():
+                        # nothing to drop but the new notification itself
+                        return
+                    break
+                await self._cond.wait()
+            self.items.append(n)
+            self._cond.notify_all()
+
+    async def get(self):
+        while True:
+            if self.spilled and len(self.items) < self.maxsize // 2:
+                await self._refill()
+            async with self._cond:
+                if self.items:
+                    n = self.items.popleft()
+                    self._cond.notify_all()
+                    return n
+                if not self.spilled:
+                    await self._cond.wait()
+
+    def _drop_follow(self, n):
+        """Drop the oldest follow notification, the new one if none is queued"""
+        for i, queued in enumerate(self.items):
+            if queued.get("type") == "follow":
+                del self.items[i]
+                self._dropped(queued)
+                return True
+        if n.get("type") == "follow":
+            self._dropped(n)
+            return True
+        return False
+
+    def _dropped(self, n):
+        self.log.warning(f"queue is full, dropped follow notification: {n['id']}")
+        if self.on_drop:
+            self.on_drop(n)
+
+    async def _spill(self, n):
+        await db.SpilledNotification.objects.create(board=self.board, notif_id=n["id"],
+                                                    payload=orjson.dumps(n).decode())
+        self.spilled += 1
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def _refill(self):
+        async with self._refill_lock:
+            if not self.spilled:
+                return
+            rows = await db.SpilledNotification.objects.filter(board=self.board).order_by("id").limit(
+                max(self.maxsize // 2, 1)).all()
+            if rows:
+                await db.SpilledNotification.objects.filter(id__in=[r.id for r in rows]).delete()
+            self.spilled = max(self.spilled - len(rows), 0) if rows else 0
+            async with self._cond:
+                self.items.extend(orjson.loads(r.payload) for r in rows)
+                self._cond.notify_all()
+            self.log.debug(f"read {len(rows)} spilled notifications back, {self.spilled} left")
+        if not self.spilled and self.on_drained:
+            self.on_drained()
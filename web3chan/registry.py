@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from web3chan import db
+
+BOARD_FIELDS = ("access_token", "enabled", "streaming", "autofollow", "replies")
+
+
+def board_state(board):
+    """Settings of a cached board, to find out what a reload changed"""
+    state = {field: getattr(board, field) for field in BOARD_FIELDS}
+    state["base_url"] = board.instance.base_url
+    return state
+
+
+class BoardRegistry:
+    """Write-through in-memory copy of the boards and instances tables
+
+    Loaded on startup, changes made through BotMaster go to the database and to
+    the cached rows, so reads cost no database round-trips. Cached Board objects
+    are shared with running BoardBots and updated in place, never replaced."""
+    def __init__(self):
+        self.log = logging.getLogger("BoardRegistry")
+        # board name to Board, instance is loaded
+        self.boards = {}
+        # base_url to Instance
+        self.instances = {}
+        self._lock = asyncio.Lock()
+        # base_url to the task registering an app there
+        self._registering = {}
+
+    async def load(self):
+        """(Re)read both tables, e.g. boards added by other cluster nodes"""
+        async with self._lock:
+            instances = {i.base_url: i for i in await db.Instance.objects.all()}
+            boards = await db.Board.objects.select_related("instance").all()
+            for base_url, instance in instances.items():
+                if base_url in self.instances:
+                    self.instances[base_url].client_id = instance.client_id
+                    self.instances[base_url].client_secret = instance.client_secret
+                else:
+                    self.instances[base_url] = instance
+            for base_url in self.instances.keys() - instances.keys():
+                del self.instances[base_url]
+
+            for board in boards:
+                self._merge(board)
+            for name in self.boards.keys() - {b.name for b in boards}:
+                del self.boards[name]
+        return list(self.boards.values())
+
+    def _merge(self, board):
+        """Cache a Board row read from the database, returns the cached object"""
+        board.instance = self.instances.setdefault(board.instance.base_url, board.instance)
+        cached = self.boards.get(board.name)
+        if cached is None or cached.id != board.id:
+            self.boards[board.name] = board
+            return board
+        for field in BOARD_FIELDS:
+            setattr(cached, field, getattr(board, field))
+        cached.instance = board.instance
+        return cached
+
+    async def refresh(self, name):
+        """Re-read one board, after it was changed by another process"""
+        board = await db.Board.objects.select_related("instance").filter(name=name).first()
+        if board is None:
+            self.boards.pop(name, None)
+            return None
+        return self._merge(board)
+
+    def all(self):
+        return list(self.boards.values())
+
+    async def get(self, name):
+        """Board by name, boards that aren't cached yet are looked up in the database"""
+        board = self.boards.get(name)
+        if board is None:
+            board = await self.refresh(name)
+        return board
+
+    async def get_instance(self, base_url):
+        instance = self.instances.get(base_url)
+        if instance is None:
+            instance = await db.Instance.objects.filter(base_url=base_url).first()
+            if instance is not None:
+                instance = self.instances.setdefault(base_url, instance)
+        return instance
+
+    async def get_or_create_instance(self, base_url, create_app):
+        """Instance of base_url, create_app() registers an app if it's a new one
+
+        Concurrent calls for the same new instance share one registration."""
+        task = self._registering.get(base_url)
+        if task is None:
+            instance = await self.get_instance(base_url)
+            if instance is not None:
+                return instance
+            # another call may have started or finished registering while we were querying
+            task = self._registering.get(base_url)
+            if task is None and base_url in self.instances:
+                return self.instances[base_url]
+        if task is None:
+            task = self._registering[base_url] = asyncio.ensure_future(self._register(base_url, create_app))
+            task.add_done_callback(lambda _: self._registering.pop(base_url, None))
+        return await asyncio.shield(task)
+
+    async def _register(self, base_url, create_app):
+        client_id, client_secret = await create_app()
+        return await self.create_instance(base_url, client_id, client_secret)
+
+    async def create_instance(self, base_url, client_id, client_secret):
+        instance = await db.Instance.objects.create(base_url=base_url, client_id=client_id, client_secret=client_secret)
+        self.instances[base_url] = instance
+        return instance
+
+    async def create_board(self, name, instance, **fields):
+        board = await db.Board.objects.create(name=name, instance=instance, **fields)
+        self.boards[name] = board
+        return board
+
+    async def update_board(self, board, **fields):
+        """Update fields in the database and on the cached (and shared) Board object"""
+        await board.update(**fields)
+        self.boards.setdefault(board.name, board)
+
+    async def delete_board(self, board):
+        await board.delete()
+        self.boards.pop(board.name, None)
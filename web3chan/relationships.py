@@ -0,0 +1,197 @@
+import asyncio
+import logging
+
+from web3chan import config, db, scheduler
+from web3chan.cache import TTLCache
+from web3chan.utils import iter_pages
+
+PAGE_LIMIT = 80
+
+
+class RelationshipSet:
+    """Set of account ids backed by a database table"""
+    def __init__(self, model, board):
+        self.model = model
+        self.board = board
+        self.ids = set()
+
+    def __contains__(self, account_id):
+        return account_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    async def load(self):
+        rows = await self.model.objects.filter(board=self.board).all()
+        self.ids = {r.account_id for r in rows}
+
+    async def add(self, account_ids):
+        new = set(account_ids) - self.ids
+        if new:
+            await db.insert_many(self.model, [{"board": self.board.id, "account_id": a} for a in new])
+            self.ids |= new
+
+    async def remove(self, account_ids):
+        gone = set(account_ids) & self.ids
+        if gone:
+            for chunk in db.chunks(gone):
+                await self.model.objects.filter(board=self.board, account_id__in=chunk).delete()
+            self.ids -= gone
+
+    async def replace(self, account_ids):
+        account_ids = set(account_ids)
+        await self.remove(self.ids - account_ids)
+        await self.add(account_ids)
+
+
+class RelationshipChecker:
+    """On-demand fren checks through the batched accounts/relationships endpoint
+
+    Lookups that arrive within RELATIONSHIPS_BATCH_WINDOW are combined into one
+    request of up to RELATIONSHIPS_BATCH_SIZE ids, results are cached for
+    RELATIONSHIPS_CACHE_TTL and kept up to date by follow events."""
+    def __init__(self, api, board):
+        self.api = api
+        self.log = logging.getLogger(f"RelationshipChecker:{board.name}")
+        # account id to {"following": bool, "followed_by": bool}
+        self.cache = TTLCache(config.RELATIONSHIPS_CACHE_TTL, config.RELATIONSHIPS_CACHE_SIZE)
+        self.requests = 0
+        # account id to future, of the next batch and of the batches being looked up
+        self._waiting = {}
+        self._in_flight = {}
+        self._flush_handle = None
+        self._lookups = set()
+
+    async def is_fren(self, account_id):
+        relationship = self.cache.get(account_id)
+        if relationship is None:
+            relationship = await asyncio.shield(self._wait_for(account_id))
+        return relationship["following"] and relationship["followed_by"]
+
+    def update(self, account_id, **fields):
+        """Apply a follow event to a cached relationship"""
+        relationship = self.cache.get(account_id)
+        if relationship is not None:
+            relationship.update(fields)
+
+    def _wait_for(self, account_id):
+        fut = self._waiting.get(account_id) or self._in_flight.get(account_id)
+        if fut is None:
+            fut = self._waiting[account_id] = asyncio.get_running_loop().create_future()
+            if len(self._waiting) >= config.RELATIONSHIPS_BATCH_SIZE:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(config.RELATIONSHIPS_BATCH_WINDOW,
+                                                                           self._flush)
+        return fut
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._waiting = self._waiting, {}
+        self._in_flight.update(batch)
+        task = asyncio.ensure_future(self._lookup(batch))
+        self._lookups.add(task)
+        task.add_done_callback(self._lookups.discard)
+
+    async def _lookup(self, batch):
+        self.requests += 1
+        try:
+            await self._request(batch)
+        finally:
+            for account_id in batch:
+                self._in_flight.pop(account_id, None)
+
+    async def _request(self, batch):
+        try:
+            with scheduler.priority(scheduler.HIGH):
+                response = await self.api.account_relationships(params={"id[]": list(batch)})
+        except Exception as e:
+            self.log.error(f"can't get relationships of {len(batch)} accounts: {type(e)}: {e}")
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        found = {r["id"]: r for r in getattr(response, "data", response)}
+        for account_id, fut in batch.items():
+            r = found.get(account_id, {})
+            relationship = {"following": bool(r.get("following")), "followed_by": bool(r.get("followed_by"))}
+            self.cache.set(account_id, relationship)
+            if not fut.done():
+                fut.set_result(relationship)
+        self.log.debug(f"looked up {len(batch)} relationships")
+
+
+class RelationshipStore:
+    """Followers and following of a board account
+
+    Syncing is incremental: pages are fetched newest first and paging stops at the
+    first known account id. A full resync only happens when the totals reported
+    by the instance don't match the local sets (i.e. somebody unfollowed)."""
+    def __init__(self, api, board):
+        self.api = api
+        self.log = logging.getLogger(f"Relationships:{board.name}")
+        self.followers = RelationshipSet(db.Follower, board)
+        self.following = RelationshipSet(db.Following, board)
+        # with RELATIONSHIPS_LAZY mentions are checked on demand instead of against the sets
+        self.checker = RelationshipChecker(api, board) if config.RELATIONSHIPS_LAZY else None
+        # set once the first sync after startup is over
+        self.synced = asyncio.Event()
+        # instance-reported totals at the time of the last full resync
+        self._full_sync_counts = {}
+
+    def is_fren(self, account_id):
+        return account_id in self.followers and account_id in self.following
+
+    async def check_fren(self, account_id):
+        """is_fren(), asking the instance in lazy mode"""
+        if self.checker is not None:
+            return await self.checker.is_fren(account_id)
+        return self.is_fren(account_id)
+
+    async def add_follower(self, account_id):
+        await self.followers.add([account_id])
+        if self.checker is not None:
+            self.checker.update(account_id, followed_by=True)
+
+    async def add_following(self, account_id):
+        await self.following.add([account_id])
+        if self.checker is not None:
+            self.checker.update(account_id, following=True)
+
+    async def load(self):
+        await self.followers.load()
+        await self.following.load()
+        self.log.debug(f"loaded {len(self.followers)} followers, {len(self.following)} following")
+
+    async def sync(self, account):
+        """Sync both sets, account is a verify_credentials response"""
+        await self._sync_set("followers", self.followers, self.api.account_followers,
+                             account["id"], account.get("followers_count"))
+        await self._sync_set("following", self.following, self.api.account_following,
+                             account["id"], account.get("following_count"))
+        self.log.debug(f"{len(self.followers)} followers, {len(self.following)} following")
+
+    async def _sync_set(self, kind, rset, endpoint, account_id, expected):
+        new, requests = [], 0
+        async for page in iter_pages(self.api, endpoint(account_id, params={"limit": PAGE_LIMIT})):
+            requests += 1
+            ids = [a["id"] for a in page]
+            fresh = [i for i in ids if i not in rset]
+            new.extend(fresh)
+            if len(fresh) < len(ids):
+                break
+        await rset.add(new)
+        self.log.debug(f"{kind}: {len(new)} new in {requests} requests")
+
+        if expected is None or len(rset) == expected or self._full_sync_counts.get(kind) == expected:
+            return
+
+        self.log.debug(f"{kind}: expected {expected}, got {len(rset)}, doing full resync")
+        ids = []
+        async for page in iter_pages(self.api, endpoint(account_id, params={"limit": PAGE_LIMIT})):
+            ids.extend(a["id"] for a in page)
+        await rset.replace(ids)
+        self._full_sync_counts[kind] = expected
@@ -1,5 +1,78 @@
+import asyncio
+import itertools
+
+import orjson
+
 OK = {"result": "ok"}
 INTERNAL_ERROR = {"error": {"code": -32603, "message": "Internal error"}}
 INVALID_REQUEST = {"error": {"code": -32600, "message": "Invalid request"}}
 PARSE_ERROR = {"error": {"code": -32700, "message": "Parse error"}}
 METHOD_NOT_FOUND = {"error": {"code": -32601, "message": "Method not found"}}
+INVALID_PARAMS = {"error": {"code": -32602, "message": "Invalid params"}}
+
+
+class Client:
+    """Persistent JSON-RPC connection to another web3chan process
+
+    Concurrent calls are pipelined over one connection and matched by id,
+    the connection is reopened on the next call after it breaks. Calls raise
+    asyncio.TimeoutError after timeout seconds, None waits forever."""
+    def __init__(self, host, port, timeout=None):
+        self.host, self.port = host, port
+        self.timeout = timeout
+        self.writer = None
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self._reader_task = asyncio.create_task(self._read(reader, self.writer))
+
+    async def _read(self, reader, writer):
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                response = orjson.loads(data)
+                fut = self._pending.pop(response.pop("id", None), None)
+                if fut is not None and not fut.done():
+                    response.pop("jsonrpc", None)
+                    fut.set_result(response)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            if self.writer is writer:
+                self.writer = None
+            writer.close()
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("connection closed"))
+            self._pending.clear()
+
+    async def call(self, method, *args, **kwargs):
+        """Call a method, returns the response without jsonrpc and id"""
+        async with self._lock:
+            if self.writer is None:
+                await self._connect()
+            # the reader may drop the connection at any await from here on
+            writer = self.writer
+        if writer.is_closing():
+            raise ConnectionError("connection closed")
+        request_id = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = fut
+        request = {"jsonrpc": "2.0", "id": request_id, "method": method,
+                   "params": {"args": list(args), "kwargs": kwargs}}
+        try:
+            writer.write(orjson.dumps(request) + b"\n")
+            await writer.drain()
+            return await asyncio.wait_for(fut, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
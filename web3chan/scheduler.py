@@ -0,0 +1,222 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+import httpx
+
+from web3chan import config
+from web3chan.metrics import registry, endpoint
+
+# request priorities, lower value goes first
+HIGH, NORMAL, BACKGROUND = 0, 1, 2
+# share of the rate limit budget that a priority leaves untouched for more important requests
+RESERVE = {HIGH: 0.0, NORMAL: 0.1, BACKGROUND: 0.3}
+
+current_priority = ContextVar("current_priority", default=NORMAL)
+
+
+@contextmanager
+def priority(level):
+    """Send all requests made inside this block with the given priority"""
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+def instance_key(url):
+    """Scheduler key (instance base URL) of a httpx.URL"""
+    if url.port:
+        return f"{url.scheme}://{url.host}:{url.port}"
+    return f"{url.scheme}://{url.host}"
+
+
+class Budget:
+    """Rate limit budget learned from X-RateLimit-* response headers"""
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, headers):
+        try:
+            self.limit = int(headers["x-ratelimit-limit"])
+            self.remaining = int(headers["x-ratelimit-remaining"])
+            reset = datetime.fromisoformat(headers["x-ratelimit-reset"].replace("Z", "+00:00"))
+        except (KeyError, ValueError):
+            return
+        self.reset_at = time.monotonic() + max(reset.timestamp() - time.time(), 0)
+
+    def exhaust(self, headers):
+        """Called on HTTP 429"""
+        self.update(headers)
+        self.remaining = 0
+        # no headers, let a single request through after the wait to learn the limit
+        self.limit = self.limit or 1
+        if self.reset_at <= time.monotonic():
+            self.reset_at = time.monotonic() + config.RATELIMIT_DEFAULT_WAIT
+
+    def delay(self, level):
+        """Seconds to wait before a request with this priority may be sent"""
+        if self.remaining is None:
+            return 0
+        now = time.monotonic()
+        if now >= self.reset_at:
+            # the window is over, optimistically assume a full budget until told otherwise
+            self.remaining = self.limit
+        if self.remaining > self.limit * RESERVE[level]:
+            self.remaining -= 1
+            return 0
+        return max(self.reset_at - now, 0.1)
+
+
+class InstanceScheduler:
+    """Queues all requests to one instance
+
+    At most RATELIMIT_CONCURRENCY requests are in flight, waiting requests are
+    released in priority order. Budgets are tracked per access token, because
+    that is what Mastodon rate limits. Every instance has its own connection pool."""
+    def __init__(self, base_url, transport):
+        self.base_url = base_url
+        self.transport = transport
+        self.log = logging.getLogger(f"Scheduler:{base_url}")
+        self.budgets = {}
+        self.in_flight = 0
+        self.waiters = []
+        self._counter = itertools.count()
+        self.requests = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+
+    def stats(self):
+        stats = {"in_flight": self.in_flight, "waiting": len(self.waiters),
+                 "budgets": [(b.remaining, b.limit) for b in self.budgets.values()],
+                 "requests": self.requests,
+                 "pool_wait_avg": self.pool_wait_total / self.requests if self.requests else 0.0,
+                 "pool_wait_max": self.pool_wait_max}
+        pool = getattr(self.transport, "_pool", None)
+        if pool is not None:
+            connections = pool.connections
+            idle = sum(1 for c in connections if c.is_idle())
+            stats.update({"connections_active": len(connections) - idle, "connections_idle": idle,
+                          "connections_http2": sum(1 for c in connections if "HTTP/2" in c.info())})
+        return stats
+
+    def _tracer(self):
+        """httpcore trace callback that measures how long a request waited for a connection"""
+        started, assigned = time.monotonic(), False
+
+        async def trace(event_name, info):
+            nonlocal assigned
+            if assigned:
+                return
+            # the first event is either opening a new connection or sending over a pooled one
+            if event_name.startswith("connection.") or event_name.endswith("send_request_headers.started"):
+                assigned = True
+                wait = time.monotonic() - started
+                self.pool_wait_total += wait
+                self.pool_wait_max = max(self.pool_wait_max, wait)
+
+        return trace
+
+    async def _acquire(self, level):
+        if self.in_flight < config.RATELIMIT_CONCURRENCY and not self.waiters:
+            self.in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (level, next(self._counter), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # slot was handed over already, pass it on
+                self._release()
+            raise
+
+    def _release(self):
+        while self.waiters:
+            _, _, fut = heapq.heappop(self.waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.in_flight -= 1
+
+    async def send(self, request, level):
+        budget = self.budgets.setdefault(request.headers.get("authorization", ""), Budget())
+        for attempt in range(config.RATELIMIT_MAX_RETRIES + 1):
+            delay = budget.delay(level)
+            while delay:
+                self.log.debug(f"rate limit budget is low, delaying request for {delay:.1f}s")
+                await asyncio.sleep(delay)
+                delay = budget.delay(level)
+
+            await self._acquire(level)
+            self.requests += 1
+            request.extensions["trace"] = self._tracer()
+            labels = (("instance", self.base_url), ("endpoint", endpoint(request.method, request.url.path)))
+            started = time.monotonic()
+            try:
+                response = await self.transport.handle_async_request(request)
+            except Exception:
+                registry.inc("web3chan_api_errors_total", labels + (("status", "exception"),))
+                raise
+            finally:
+                self._release()
+                registry.observe("web3chan_api_request_seconds", time.monotonic() - started, labels)
+
+            if response.status_code >= 400:
+                registry.inc("web3chan_api_errors_total", labels + (("status", str(response.status_code)),))
+
+            if response.status_code != 429 or attempt == config.RATELIMIT_MAX_RETRIES:
+                budget.update(response.headers)
+                return response
+
+            self.log.warning(f"rate limited: {request.method} {request.url.path}")
+            budget.exhaust(response.headers)
+            await response.aclose()
+
+
+def instance_transport():
+    """Connection pool for a single instance, configured with HTTP_* settings"""
+    http2 = config.HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.getLogger("Scheduler").error("HTTP/2 support is not installed, pip install httpx[http2]")
+            http2 = False
+
+    limits = httpx.Limits(max_connections=config.HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY)
+    return httpx.AsyncHTTPTransport(http2=http2, limits=limits)
+
+
+class SchedulingTransport(httpx.AsyncBaseTransport):
+    """httpx transport that sends requests through per-instance schedulers"""
+    def __init__(self, transport_factory=instance_transport):
+        self.transport_factory = transport_factory
+        self.schedulers = {}
+
+    def scheduler(self, base_url):
+        if base_url not in self.schedulers:
+            self.schedulers[base_url] = InstanceScheduler(base_url, self.transport_factory())
+        return self.schedulers[base_url]
+
+    def stats(self):
+        return {base_url: s.stats() for base_url, s in self.schedulers.items()}
+
+    async def handle_async_request(self, request):
+        scheduler = self.scheduler(instance_key(request.url))
+        return await scheduler.send(request, current_priority.get())
+
+    async def aclose(self):
+        for s in self.schedulers.values():
+            await s.transport.aclose()
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+from web3chan import config, rpc, cluster, metrics
+from web3chan.master import BotMaster
+from web3chan.utils import HashRing
+
+
+def worker_address(index):
+    """RPC address of a worker process, ports following WEB3CHAN_RPC_ADDRESS"""
+    host, port = config.RPC_ADDRESS.split(":")
+    return host, int(port) + 1 + index
+
+
+class ShardedBotMaster(BotMaster):
+    """BotMaster that runs boards in WEB3CHAN_WORKERS worker processes
+
+    Every worker is a BotMaster that only starts the boards assigned to it by
+    consistent hashing on board name. Board RPC methods are forwarded to the
+    owning worker, crashed workers are restarted."""
+    def __init__(self, workers):
+        super().__init__()
+        self.log = logging.getLogger("ShardedBotMaster")
+        # with clustering the workers hold the leases
+        self.leases = None
+        self.worker_count = workers
+        self.ring = HashRing(range(workers))
+        self.workers = {}
+        self.supervisors = []
+        self.clients = {i: rpc.Client(*worker_address(i), timeout=config.RPC_CALL_TIMEOUT) for i in range(workers)}
+
+    async def start_slaves(self):
+        self.supervisors = [asyncio.create_task(self._supervise(i)) for i in range(self.worker_count)]
+
+    async def stop_slaves(self):
+        for proc in self.workers.values():
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGINT)
+        await asyncio.gather(*self.supervisors)
+        for client in self.clients.values():
+            await client.close()
+
+    async def _supervise(self, index):
+        """Run a worker process and restart it when it dies"""
+        host, port = worker_address(index)
+        env = dict(os.environ, WEB3CHAN_RPC_ADDRESS=f"{host}:{port}", WEB3CHAN_RPC_SOCKET="",
+                   WEB3CHAN_METRICS_ADDRESS="", WEB3CHAN_NODE_ID=f"{config.NODE_ID}/{index}")
+        while not self.stop_event.is_set():
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "web3chan", "-d",
+                "--worker", str(index), "--workers", str(self.worker_count),
+                env=env, start_new_session=True
+            )
+            self.workers[index] = proc
+            self.log.info(f"worker {index} started, pid {proc.pid}")
+            code = await proc.wait()
+            if self.stop_event.is_set():
+                break
+            self.log.error(f"worker {index} exited with code {code}, restarting")
+            await asyncio.sleep(config.WORKER_RESTART_DELAY)
+
+    async def _call(self, index, method, *args, **kwargs):
+        try:
+            return await self.clients[index].call(method, *args, **kwargs)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            self.log.error(f"worker {index}: can't call {method}: {type(e)}: {e}")
+            return rpc.INTERNAL_ERROR
+
+    async def _gather_workers(self, method, *args, workers=None):
+        """Call a method on workers concurrently, returns worker index to result or error"""
+        workers = range(self.worker_count) if workers is None else workers
+        responses = await asyncio.gather(*[self._call(i, method, *args) for i in workers])
+        return {str(i): r.get("result", r.get("error")) for i, r in zip(workers, responses)}
+
+    async def _owner(self, name):
+        """Index of the worker that runs the board"""
+        if not config.CLUSTER:
+            return self.ring.node_for(name)
+        # with clustering every worker is a node of its own and holds leases
+        owner = (await cluster.lease_owners()).get(name, "")
+        node_id, _, index = owner.rpartition("/")
+        if node_id != config.NODE_ID:
+            return self.ring.node_for(name)
+        return int(index)
+
+    async def _call_owner(self, name, method, *args, **kwargs):
+        return await self._call(await self._owner(name), method, name, *args, **kwargs)
+
+    async def start_board(self, name):
+        """start_board
+
+        arguments: name"""
+        return await self._call_owner(name, "start_board")
+
+    async def stop_board(self, name):
+        """stop_board
+
+        arguments: name"""
+        return await self._call_owner(name, "stop_board")
+
+    async def restart_board(self, name):
+        """restart_board
+
+        arguments: name"""
+        return await self._call_owner(name, "restart_board")
+
+    async def toggle_board_option(self, name, field):
+        """toggle_board_option - toggle boolean option in the database and apply it to the running board
+
+        arguments: name, field"""
+        response = await super().toggle_board_option(name, field)
+        if response == rpc.OK:
+            # the worker caches board rows too
+            await self._call_owner(name, "refresh_board")
+        return response
+
+    async def remove_board(self, name):
+        """remove_board
+
+        arguments: name"""
+        response = await super().remove_board(name)
+        if response == rpc.OK:
+            # drops the board from the worker's registry
+            await self._call_owner(name, "refresh_board")
+        return response
+
+    async def _stop_everywhere(self, board):
+        await self._call_owner(board.name, "stop_board")
+        await super()._stop_everywhere(board)
+
+    async def refresh_board(self, name):
+        """refresh_board - re-read board settings from the database and apply them to the running board
+
+        arguments: name"""
+        await self.boards.refresh(name)
+        return await self._call_owner(name, "refresh_board")
+
+    async def apply_changes(self, name, old):
+        # boards run in the workers, they apply changes on refresh_board and reload
+        return None
+
+    async def reload(self):
+        """reload - re-read all boards from the database and apply what changed, also done on SIGHUP
+
+        returns what every worker started, stopped, restarted or updated"""
+        response = await super().reload()
+        if "error" in response:
+            return response
+        return {"result": await self._gather_workers("reload")}
+
+    async def mastoapi(self, name, method, *args, **kwargs):
+        """mastoapi - execute MastoAPI method with a board account, returns API response
+
+        arguments: name, method, *args, **kwargs"""
+        return await self._call_owner(name, "mastoapi", method, *args, **kwargs)
+
+    async def list_boards(self):
+        """list_boards - returns a list of all boards hosted on this web3chan node"""
+        results = await self._gather_workers("list_boards")
+        running = {b[0]: b[6] for r in results.values() if type(r) == list for b in r if b[2]}
+        owners = await cluster.lease_owners() if config.CLUSTER else running
+        boards = self.boards.all()
+        return {"result": [(b.name, b.enabled, b.name in running, b.streaming, b.autofollow, b.replies,
+                            owners.get(b.name)) for b in boards]}
+
+    async def startup_status(self):
+        """startup_status - returns boards that are starting, syncing relationships or failed to start"""
+        return {"result": await self._gather_workers("startup_status")}
+
+    async def pool_stats(self):
+        """pool_stats - returns connection pool and request scheduler stats per instance"""
+        return {"result": await self._gather_workers("pool_stats")}
+
+    async def metrics(self):
+        """metrics - returns counters, gauges and latency histograms of this process"""
+        result = await self._gather_workers("metrics")
+        result["master"] = (await super().metrics())["result"]
+        return {"result": result}
+
+    async def prometheus(self):
+        """prometheus - returns metrics of the master and all workers in Prometheus text format
+
+        series get a worker label, "master" for the master process"""
+        text = metrics.with_label(metrics.registry.prometheus(), "worker", "master")
+        for i, r in (await self._gather_workers("prometheus")).items():
+            if type(r) == str:
+                text += metrics.with_label(r, "worker", i)
+        return {"result": text}
+
+    async def list_timers(self):
+        """list_timers - returns periodic board jobs (fetcher, relationships, cursor) and interval overrides"""
+        return {"result": await self._gather_workers("list_timers")}
+
+    async def profile_start(self, mode="sampling", duration=60, worker=None):
+        """profile_start - start profiling the event loop of workers, stops by itself after duration seconds
+
+        arguments: mode (sampling or cprofile), duration, worker (omit for all workers)"""
+        workers = range(self.worker_count) if worker is None else [int(worker)]
+        return {"result": await self._gather_workers("profile_start", mode, duration, workers=workers)}
+
+    async def profile_stop(self, limit=40, sort="cumulative", dump=None, worker=None):
+        """profile_stop - stop profiling, returns a report per worker or writes stats to <dump>.<worker>
+
+        arguments: limit, sort (cprofile sort key), dump (path of the stats file on the daemon host), worker"""
+        workers = range(self.worker_count) if worker is None else [int(worker)]
+        # every worker dumps to a file of its own
+        results = await asyncio.gather(*[self._gather_workers("profile_stop", limit, sort,
+                                                              f"{dump}.{i}" if dump else None, workers=[i])
+                                         for i in workers])
+        return {"result": {i: r for result in results for i, r in result.items()}}
+
+    async def slow_callbacks(self, threshold=None):
+        """slow_callbacks - report callbacks that block the event loop, returns the recent ones per worker
+
+        arguments: threshold (seconds, 0 turns detection off, omit to keep the current setting)"""
+        return {"result": await self._gather_workers("slow_callbacks", threshold)}
+
+    async def list_tasks(self, name=None):
+        """list_tasks - returns live asyncio tasks per board with the point they are waiting at
+
+        arguments: name (omit for all boards)"""
+        if name is not None:
+            return await self._call_owner(name, "list_tasks")
+        return {"result": await self._gather_workers("list_tasks")}
+
+    async def set_timer_interval(self, kind, seconds=None, name=None):
+        """set_timer_interval - change the interval of a kind of periodic job at runtime
+
+        arguments: kind, seconds (omit to go back to the default), name (omit for all boards)"""
+        if name is not None:
+            return await self._call(await self._owner(name), "set_timer_interval", kind, seconds, name)
+        results = await self._gather_workers("set_timer_interval", kind, seconds)
+        return {"result": sum(r for r in results.values() if type(r) == int)}
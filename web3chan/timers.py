@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+
+from web3chan import config
+
+
+class Timer:
+    """Periodic job of a board, owned by a TimerWheel"""
+    def __init__(self, wheel, name, kind, callback, interval, limited=True):
+        self.wheel = wheel
+        self.name = name
+        self.kind = kind
+        self.callback = callback
+        # seconds or a callable returning seconds
+        self.interval = interval
+        # counts against the TIMER_CONCURRENCY of its kind
+        self.limited = limited
+        self.override = None
+        self.deadline = None
+        self.task = None
+        self.triggered = False
+        self.cancelled = False
+        self.runs = 0
+
+    def current_interval(self):
+        if self.override is not None:
+            return self.override
+        return self.interval() if callable(self.interval) else self.interval
+
+    def trigger(self):
+        """Run as soon as possible"""
+        if self.task is not None:
+            self.triggered = True
+        elif not self.cancelled:
+            self.wheel._schedule(self, 0)
+
+    async def cancel(self):
+        self.cancelled = True
+        self.wheel.timers.discard(self)
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+class TimerWheel:
+    """Runs the periodic jobs of all boards from a single task
+
+    Deadlines get TIMER_JITTER so boards started together drift apart, and
+    timers that are due within TIMER_RESOLUTION of each other fire in the same
+    wakeup. At most TIMER_CONCURRENCY jobs of each kind run at once, so fetchers
+    stuck on backpressure or rate limits don't hold back other kinds of jobs.
+    Unlimited jobs, like quick cursor flushes, always run. Intervals can be
+    overridden per kind of job at runtime."""
+    def __init__(self):
+        self.log = logging.getLogger("TimerWheel")
+        self.heap = []
+        self.timers = set()
+        # kind of timer to interval in seconds
+        self.overrides = {}
+        # kind of timer to the semaphore limiting its concurrency
+        self.semaphores = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def add(self, name, kind, callback, interval, delay=None, limited=True):
+        """Schedule callback every interval seconds, first run after delay (a random share of interval by default)
+
+        limited timers count against TIMER_CONCURRENCY of their kind"""
+        timer = Timer(self, name, kind, callback, interval, limited)
+        timer.override = self.overrides.get(kind)
+        self.timers.add(timer)
+        if delay is None:
+            delay = random.uniform(0, timer.current_interval())
+        self._schedule(timer, delay)
+        return timer
+
+    def set_interval(self, kind, seconds, name=None):
+        """Override interval of a kind of timer, for one board or all of them. None goes back to the default"""
+        if name is None:
+            if seconds is None:
+                self.overrides.pop(kind, None)
+            else:
+                self.overrides[kind] = seconds
+        changed = 0
+        for timer in self.timers:
+            if timer.kind == kind and (name is None or timer.name == name):
+                timer.override = seconds
+                if timer.task is None:
+                    self._schedule(timer, self._jitter(timer.current_interval()))
+                changed += 1
+        return changed
+
+    def stats(self):
+        kinds = {}
+        for timer in self.timers:
+            kind = kinds.setdefault(timer.kind, {"timers": 0, "running": 0, "runs": 0})
+            kind["timers"] += 1
+            kind["running"] += timer.task is not None
+            kind["runs"] += timer.runs
+        return {"timers": len(self.timers), "overrides": self.overrides, "kinds": kinds}
+
+    def _jitter(self, interval):
+        # timers fire up to TIMER_RESOLUTION early, shorter intervals would fire back to back
+        interval = max(interval, config.TIMER_RESOLUTION)
+        return interval * (1 + random.uniform(-config.TIMER_JITTER, config.TIMER_JITTER))
+
+    def _schedule(self, timer, delay):
+        loop = asyncio.get_running_loop()
+        timer.deadline = loop.time() + delay
+        # the old heap entry, if any, becomes stale and is skipped
+        heapq.heappush(self.heap, (timer.deadline, next(self._counter), timer))
+        if self.heap[0][2] is timer:
+            self._wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self.heap and self.heap[0][0] <= now + config.TIMER_RESOLUTION:
+                deadline, _, timer = heapq.heappop(self.heap)
+                if timer.cancelled or timer.deadline != deadline or timer.task is not None:
+                    continue
+                timer.deadline = None
+                timer.task = asyncio.create_task(self._run_timer(timer), name=f"{timer.name}/{timer.kind}")
+
+            self._wakeup.clear()
+            timeout = self.heap[0][0] - loop.time() if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_timer(self, timer):
+        try:
+            if timer.limited:
+                semaphore = self.semaphores.get(timer.kind)
+                if semaphore is None:
+                    semaphore = self.semaphores[timer.kind] = asyncio.Semaphore(config.TIMER_CONCURRENCY)
+                async with semaphore:
+                    await timer.callback()
+            else:
+                await timer.callback()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.error(f"{timer.name}/{timer.kind}: {type(e)}: {e}")
+        finally:
+            timer.task = None
+            timer.runs += 1
+
+        if not timer.cancelled:
+            delay = 0 if timer.triggered else self._jitter(timer.current_interval())
+            timer.triggered = False
+            self._schedule(timer, delay)
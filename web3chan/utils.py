@@ -0,0 +1,54 @@
+import bisect
+import hashlib
+
+from collections import OrderedDict
+
+
+async def iter_pages(api, coro):
+    """Iterate over a paginated API response page by page, newest page first"""
+    page = await coro
+    while page is not None and page.data:
+        yield page.data
+        page = await api.get_next(page)
+
+
+def id_key(object_id):
+    """Sort key for Mastodon/Pleroma ids, which are numeric or fixed-width strings"""
+    return len(object_id), object_id
+
+
+class SeenCache:
+    """Bounded set of recently seen ids, oldest ids are evicted first"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, key):
+        """Add key, returns False if it has been seen already"""
+        if key in self._ids:
+            return False
+        self._ids[key] = None
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+        return True
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring, maps keys (board names) to nodes"""
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted((_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [h for h, _ in self.ring]
+
+    def node_for(self, key):
+        i = bisect.bisect(self.hashes, _hash(key)) % len(self.ring)
+        return self.ring[i][1]
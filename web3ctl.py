@@ -1,21 +1,22 @@
 #!/usr/bin/python3
 import os
 import sys
+import shlex
 import asyncio
 import argparse
 import json
 
 RPC_ADDRESS = os.getenv("WEB3CHAN_RPC_ADDRESS", "127.0.0.1:18166")
+RPC_SOCKET = os.getenv("WEB3CHAN_RPC_SOCKET", "")
 
 
 def fatal_error(message):
     print(f"ERROR: {message}")
     sys.exit(2)
 
-def print_response(args, response_data):
-    response = json.loads(response_data.decode())
+def print_response(args, response):
     if args.json:
-        print(response_data.decode())
+        print(json.dumps(response))
         return
 
     if "error" in response:
@@ -24,29 +25,80 @@ def print_response(args, response_data):
         if type(response["result"]) == str and response["result"] == "ok":
             print("OK")
         elif args.command == "list_boards":
-            print("name\t\t\t\tenabled?\trunning?\tstreaming\tautofollow\treplies")
+            print("name\t\t\t\tenabled?\trunning?\tstreaming\tautofollow\treplies\t\tnode")
             for b in response["result"]:
                 print("\t\t".join([str(v) for v in b]))
-        elif args.command == "mastoapi":
+        elif args.command == "add_boards":
+            print("name\t\t\t\tadded?\t\tstarted?")
+            for b in response["result"]:
+                print("\t\t".join([str(b["name"]), str(b["added"]), str(b["started"])]))
+        elif args.command in ("mastoapi", "slow_callbacks", "profile_start"):
             print(json.dumps(response["result"], indent=1))
+        elif args.command == "list_tasks":
+            print_tasks(response["result"])
+        elif args.command == "reload":
+            print_reload(response["result"])
+        elif args.command in ("profile", "profile_stop") and type(response["result"]) == dict:
+            for worker, report in response["result"].items():
+                print(f"=== worker {worker} ===\n{report}")
         else:
             print(response["result"])
     else:
         print(response)
 
+def print_tasks(tasks, indent=""):
+    for group, items in sorted(tasks.items()):
+        if type(items) == dict:
+            # sharded daemon, tasks per worker
+            print(f"{indent}worker {group}:")
+            print_tasks(items, indent + "  ")
+            continue
+        print(f"{indent}{group}: {len(items)} tasks")
+        for t in items:
+            print(f"{indent}  {t['task']}: {' -> '.join(t['await'])}")
 
-async def main():
-    host, port = RPC_ADDRESS.split(":")
+def print_reload(changes, indent=""):
+    if not changes:
+        print(f"{indent}no changes")
+    for group, boards in sorted(changes.items()):
+        if group.isdigit():
+            # sharded daemon, changes per worker
+            print(f"{indent}worker {group}:")
+            print_reload(boards, indent + "  ")
+            continue
+        for name, fields in sorted(boards.items()):
+            print(f"{indent}{group}\t{name}\t{', '.join(fields)}")
+
+def make_parser():
     parser = argparse.ArgumentParser(description="Utility to control web3chan daemon", epilog="Use 'help' command to see all available commands")
-    parser.add_argument("command")
+    parser.add_argument("command", nargs="?")
     parser.add_argument("args", nargs="*")
     parser.add_argument("-k", "--kwargs", action="extend", nargs="*")
     parser.add_argument('-j', '--json', action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help="read commands from stdin, one per line, and send them over one connection")
+    return parser
 
-    request = {"jsonrpc": "2.0", "id": 420,
+def read_boards(paths):
+    """Boards for add_boards, one 'name base_url email password' line each, '-' reads stdin"""
+    boards = []
+    for path in paths:
+        f = sys.stdin if path == "-" else open(path)
+        with f:
+            for line in f:
+                if line.strip() and not line.lstrip().startswith("#"):
+                    boards.append(line.split())
+    return boards
+
+def make_request(args, request_id):
+    request = {"jsonrpc": "2.0", "id": request_id,
                "method": args.command, "params": {}}
-    if args.args:
+    if args.command == "add_boards":
+        try:
+            request["params"]["args"] = [read_boards(args.args or ["-"])]
+        except OSError as e:
+            fatal_error(f"can't read boards: {e}")
+    elif args.args:
         request["params"]["args"] = args.args
     if args.kwargs:
         request["params"]["kwargs"] = {}
@@ -56,21 +108,107 @@ async def main():
                 request["params"]["kwargs"][k] = v
             except Exception as e:
                 fatal_error(f"invalid kwargs: {type(e)}, {e}")
+    return request
 
+async def connect():
     try:
-        reader, writer = await asyncio.open_connection(host, int(port))
-    except ConnectionRefusedError as e:
+        if RPC_SOCKET:
+            return await asyncio.open_unix_connection(RPC_SOCKET)
+        host, port = RPC_ADDRESS.split(":")
+        return await asyncio.open_connection(host, int(port))
+    except (ConnectionRefusedError, FileNotFoundError) as e:
         fatal_error(f"can't connect to web3chan daemon: {e}")
 
-    writer.write(json.dumps(request).encode())
+async def call(method, params):
+    reader, writer = await connect()
+    writer.write(json.dumps({"jsonrpc": "2.0", "id": 420, "method": method, "params": params}).encode())
+    writer.write("\n".encode())
+    await writer.drain()
+    response_data = await reader.readline()
+    writer.close()
+    await writer.wait_closed()
+    return json.loads(response_data.decode())
+
+async def run_profile(args):
+    """profile [mode] [duration] - profile the daemon for duration seconds and print the report
+
+    -k arguments go to profile_stop (limit, sort, dump)"""
+    mode = args.args[0] if args.args else "sampling"
+    duration = float(args.args[1]) if len(args.args) > 1 else 30
+    response = await call("profile_start", {"args": [mode, duration]})
+    if "error" in response:
+        print_response(args, response)
+        return
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        # also stops the profiler on ^C
+        stop_request = make_request(argparse.Namespace(command="profile_stop", args=[], kwargs=args.kwargs), 420)
+        print_response(args, await call("profile_stop", stop_request["params"]))
+
+async def run_batch(parser, args):
+    """Pipeline all commands from stdin over one connection, print responses in input order"""
+    commands = []
+    for line in sys.stdin:
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        command = parser.parse_args(shlex.split(line))
+        command.json = command.json or args.json
+        commands.append(command)
+
+    reader, writer = await connect()
+    for i, command in enumerate(commands):
+        writer.write(json.dumps(make_request(command, i)).encode())
+        writer.write("\n".encode())
+    await writer.drain()
+
+    responses = {}
+    while len(responses) < len(commands):
+        data = await reader.readline()
+        if not data:
+            break
+        response = json.loads(data.decode())
+        responses[response.get("id")] = response
+    writer.close()
+    await writer.wait_closed()
+
+    failed = False
+    for i, command in enumerate(commands):
+        response = responses.get(i, {"error": {"message": "no response"}})
+        if "error" in response and not command.json:
+            print(f"ERROR: {response['error']['message']}")
+            failed = True
+        else:
+            print_response(command, response)
+    if failed:
+        sys.exit(2)
+
+
+async def main():
+    parser = make_parser()
+    args = parser.parse_args()
+
+    if args.batch:
+        await run_batch(parser, args)
+        return
+    if not args.command:
+        parser.print_help()
+        sys.exit(2)
+    if args.command == "profile":
+        await run_profile(args)
+        return
+
+    reader, writer = await connect()
+
+    writer.write(json.dumps(make_request(args, 420)).encode())
     writer.write("\n".encode())
     await writer.drain()
 
-    response_data = await reader.read()
+    response_data = await reader.readline()
     writer.close()
     await writer.wait_closed()
 
-    print_response(args, response_data)
+    print_response(args, json.loads(response_data.decode()))
 
 if __name__ == "__main__":
     asyncio.run(main())